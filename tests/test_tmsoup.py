@@ -8,9 +8,12 @@ test_tmsoup
 Tests for `tmsoup` module.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
-from tmsoup import tmsoup
+from tmsoup import core
 
 
 class TestTmsoup(unittest.TestCase):
@@ -24,5 +27,542 @@ class TestTmsoup(unittest.TestCase):
     def tearDown(self):
         pass
 
+
+class DatabaseTestCase(unittest.TestCase):
+    """Base for tests that need a fresh TMSU database,
+    in a temporary directory that is also the working directory."""
+
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.dir = os.path.realpath(tempfile.mkdtemp())
+        os.chdir(self.dir)
+        self.conn = core.connect(os.path.join(self.dir, 'test.db'))
+        self.cursor = self.conn.cursor()
+
+    def tearDown(self):
+        self.conn.close()
+        os.chdir(self.olddir)
+        shutil.rmtree(self.dir)
+
+    def touch(self, name, data=b''):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def add_file(self, path, fingerprint='', mod_time='', size=0,
+                 is_dir=False):
+        self.cursor.execute('INSERT INTO file (directory, name, fingerprint,'
+                            ' mod_time, size, is_dir)'
+                            ' VALUES (?, ?, ?, ?, ?, ?)',
+                            os.path.split(path) +
+                            (fingerprint, mod_time, size, is_dir))
+        return self.cursor.lastrowid
+
+
+class TestHooks(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from tmsoup import alias
+        alias.init(self.cursor)
+        alias._autoremoved_aliases.clear()
+
+    def test_alias_tag_was_deleted(self):
+        from tmsoup import alias
+        from tmsoup.tag import create_tag
+        c = self.cursor
+        apple = create_tag(c, 'apple')
+        pear = create_tag(c, 'pear')
+        c.execute("INSERT INTO alias (id, name) VALUES (1, 'fruit')")
+        c.executemany('INSERT INTO alias_tag VALUES (1, ?, 0)',
+                      [(apple,), (pear,)])
+        # as tag.delete_tag() would: the row is already gone
+        # when the hook is dispatched.
+        c.execute('DELETE FROM tag WHERE id = ?', (apple,))
+        core.dispatch_hook('after-tag-delete', c, apple, 'apple')
+        self.assertEqual(alias._autoremoved_aliases, {'fruit': 'apple pear'})
+
+
+class TestConnect(DatabaseTestCase):
+
+    def journal_mode(self, conn):
+        return conn.execute('PRAGMA journal_mode').fetchone()[0]
+
+    def test_bulk_pragmas_are_opt_in(self):
+        self.assertNotEqual(self.journal_mode(self.conn), 'wal')
+        conn = core.connect(os.path.join(self.dir, 'bulk.db'), bulk=True)
+        try:
+            self.assertEqual(self.journal_mode(conn), 'wal')
+        finally:
+            conn.close()
+
+
+class TestDbPath(DatabaseTestCase):
+
+    def test_local_db_created_after_a_miss(self):
+        os.mkdir('sub')
+        sub = os.path.join(self.dir, 'sub')
+        self.assertNotEqual(os.path.dirname(core.get_db_path(basedir=sub)),
+                            os.path.join(self.dir, '.tmsu'))
+        os.mkdir('.tmsu')
+        self.touch(os.path.join('.tmsu', 'db'))
+        self.assertEqual(core.get_db_path(basedir=sub),
+                         os.path.join(self.dir, '.tmsu', 'db'))
+
+
+class TestBatch(DatabaseTestCase):
+
+    def tag_count(self):
+        other = core.connect(os.path.join(self.dir, 'test.db'))
+        try:
+            return other.execute('SELECT count(*) FROM tag').fetchone()[0]
+        finally:
+            other.close()
+
+    def test_commits_once_on_exit(self):
+        from tmsoup.tag import create_tag
+        from tmsoup.util import batch
+        with batch(self.cursor):
+            create_tag(self.cursor, 'a')
+            with batch(self.cursor):
+                create_tag(self.cursor, 'b')
+            # do_commit() did nothing, so nothing is visible elsewhere yet.
+            self.assertTrue(self.conn.in_transaction)
+            self.assertEqual(self.tag_count(), 0)
+        self.assertFalse(self.conn.in_transaction)
+        self.assertEqual(self.tag_count(), 2)
+
+    def test_rolls_back_on_exception(self):
+        from tmsoup.tag import create_tag
+        from tmsoup.util import batch
+        with self.assertRaises(KeyError):
+            with batch(self.cursor):
+                create_tag(self.cursor, 'a')
+                raise KeyError('a')
+        self.assertEqual(self.tag_count(), 0)
+
+    def test_helper_rollback_aborts_whole_batch(self):
+        from tmsoup.tag import create_tag
+        from tmsoup.util import batch, rename, BatchRollback
+        c = self.cursor
+        # tag names aren't constrained unique, so this renames 2 rows,
+        # which rename() would roll back.
+        c.executemany('INSERT INTO tag (name) VALUES (?)', [('x',), ('x',)])
+        self.conn.commit()
+        with self.assertRaises(BatchRollback):
+            with batch(c):
+                create_tag(c, 'b')
+                rename(c, 'tag', 'x', 'y')
+        self.assertEqual(self.tag_count(), 2)
+        self.assertEqual(c.execute("SELECT count(*) FROM tag WHERE name = 'x'")
+                         .fetchone()[0], 2)
+
+    def test_other_connections_unaffected(self):
+        from tmsoup.tag import create_tag
+        from tmsoup.util import batch, do_rollback
+        other = core.connect(os.path.join(self.dir, 'other.db'))
+        try:
+            with batch(self.cursor):
+                create_tag(other.cursor(), 'b')
+                self.assertFalse(other.in_transaction)
+                other.execute("INSERT INTO tag (name) VALUES ('c')")
+                do_rollback(other.cursor())
+            self.assertEqual([n for (n,) in other.execute('SELECT name'
+                                                          ' FROM tag')],
+                             ['b'])
+        finally:
+            other.close()
+
+
+class TestScandirFallback(DatabaseTestCase):
+    """repair's directory listings give the same answers through
+    os.listdir() (Python < 3.5) as through os.scandir()."""
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('d')
+        os.mkdir(os.path.join('d', 'sub'))
+        self.touch(os.path.join('d', 'f'), b'data')
+        self.touch(os.path.join('d', '.hidden'))
+        os.symlink('f', os.path.join('d', 'link'))
+        os.symlink('nowhere', os.path.join('d', 'broken'))
+        d = os.path.join(self.dir, 'd')
+        for name in ('f', 'sub', 'link', 'broken', 'gone'):
+            self.add_file(os.path.join(d, name), is_dir=(name == 'sub'))
+
+    def results(self):
+        from tmsoup import repair
+        repair._count_files.cache_clear()
+        d = os.path.join(self.dir, 'd')
+        return (repair._count_files(d),
+                sorted(repair.unknown_paths(self.cursor)),
+                sorted(repair.changed_paths(self.cursor).items()))
+
+    def test_listdir_matches_scandir(self):
+        from unittest import mock
+        from tmsoup import repair
+        expected = self.results()
+        self.assertEqual(expected[0], 3)
+        with mock.patch.object(repair, '_scandir', repair._listdir_scandir):
+            self.assertEqual(self.results(), expected)
+
+
+class TestRenamePath(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join('old', 'sub'))
+        self.touch(os.path.join('old', 'sub', 'f'))
+        self.old = os.path.join(self.dir, 'old')
+        self.new = os.path.join(self.dir, 'new')
+        self.root_id = self.add_file(self.old, is_dir=True)
+        self.sub_id = self.add_file(os.path.join(self.old, 'sub'),
+                                    is_dir=True)
+        self.f_id = self.add_file(os.path.join(self.old, 'sub', 'f'))
+        self.conn.commit()
+
+    def rows(self):
+        return sorted(self.cursor.execute('SELECT id, directory, name'
+                                          ' FROM file'))
+
+    def test_directory(self):
+        from tmsoup.file import rename_path
+        self.assertEqual(rename_path(self.cursor, self.old, self.new), 3)
+        self.assertTrue(os.path.isfile(os.path.join(self.new, 'sub', 'f')))
+        self.assertEqual(self.rows(),
+                         [(self.root_id, self.dir, 'new'),
+                          (self.sub_id, self.new, 'sub'),
+                          (self.f_id, os.path.join(self.new, 'sub'), 'f')])
+
+    def test_directory_update_only(self):
+        from tmsoup.file import rename_path
+        rename_path(self.cursor, self.old, self.new, update_only=True)
+        self.assertTrue(os.path.isdir(self.old))
+        self.assertEqual(self.rows()[0], (self.root_id, self.dir, 'new'))
+
+    def test_directory_failed_rename_keeps_transaction(self):
+        from tmsoup.file import rename_path
+        from tmsoup.tag import create_tag
+        from tmsoup.util import batch
+        # os.rename() refuses to replace a non-empty directory.
+        os.makedirs(os.path.join('new', 'x'))
+        before = self.rows()
+        with batch(self.cursor):
+            create_tag(self.cursor, 'a')
+            with self.assertRaises(OSError):
+                rename_path(self.cursor, self.old, self.new)
+        self.assertTrue(os.path.isdir(self.old))
+        self.assertEqual(self.rows(), before)
+        # the batch's earlier work was not rolled back.
+        self.assertEqual(self.cursor.execute('SELECT name FROM tag')
+                         .fetchall(), [('a',)])
+
+    def test_file(self):
+        from tmsoup.file import rename_path
+        before = self.rows()
+        with self.assertRaises(NotImplementedError):
+            rename_path(self.cursor, os.path.join(self.old, 'sub', 'f'),
+                        os.path.join(self.old, 'g'))
+        self.assertTrue(os.path.isfile(os.path.join(self.old, 'sub', 'f')))
+        self.assertEqual(self.rows(), before)
+
+
+class TestRepairPaths(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from tmsoup.fingerprint import fingerprint
+        self.a = self.touch('a2', b'a')
+        self.b = self.touch('b2', b'b')
+        self.ids = [self.add_file(os.path.join(self.dir, name),
+                                  fingerprint(path, 'dynamic:SHA256'))
+                    for name, path in (('a', self.a), ('b', self.b))]
+        self.conn.commit()
+
+    def names(self):
+        return [n for (n,) in self.cursor.execute('SELECT name FROM file'
+                                                  ' ORDER BY id')]
+
+    def test_repairs_all_pairs(self):
+        from tmsoup.repair import repair_paths
+        pairs = [(os.path.join(self.dir, 'a'), self.a),
+                 (os.path.join(self.dir, 'b'), self.b)]
+        self.assertEqual(repair_paths(self.cursor, pairs), 2)
+        self.assertEqual(self.names(), ['a2', 'b2'])
+
+    def test_rejects_duplicate_newpaths(self):
+        from tmsoup.repair import repair_paths
+        pairs = [(os.path.join(self.dir, 'a'), self.a),
+                 (os.path.join(self.dir, 'b'), self.a)]
+        with self.assertRaises(ValueError):
+            repair_paths(self.cursor, pairs, ignore_fingerprint=True)
+        self.assertEqual(self.names(), ['a', 'b'])
+
+    def test_fingerprint_mismatch_changes_nothing(self):
+        from tmsoup.repair import repair_paths
+        pairs = [(os.path.join(self.dir, 'a'), self.a),
+                 (os.path.join(self.dir, 'b'), self.touch('c', b'c'))]
+        with self.assertRaises(ValueError):
+            repair_paths(self.cursor, pairs)
+        self.assertEqual(self.names(), ['a', 'b'])
+
+
+class TestStats(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from tmsoup.tag import create_tag
+        c = self.cursor
+        self.t, self.u = create_tag(c, 't'), create_tag(c, 'u')
+        d = os.path.join(self.dir, 'd')
+        files = [self.add_file(os.path.join(d, 'f')),
+                 self.add_file(os.path.join(d, 'sub', 'g')),
+                 self.add_file(os.path.join(d, 'sub', 'h')),
+                 # not inside d, despite the shared prefix
+                 self.add_file(os.path.join(self.dir, 'd_x', 'i')),
+                 self.add_file(os.path.join(d, 'untagged'))]
+        c.executemany('INSERT INTO file_tag VALUES (?, ?, 0)',
+                      [(files[0], self.t), (files[1], self.t),
+                       (files[2], self.t), (files[0], self.u),
+                       (files[3], self.u)])
+
+    def test_count_directory_tags(self):
+        from tmsoup.stats import count_directory_tags
+        c = self.cursor
+        d = os.path.join(self.dir, 'd')
+        # sorted by ascending (count, id)
+        self.assertEqual(count_directory_tags(c, d, recursive=True),
+                         (4, [(self.u, 1), (self.t, 3)]))
+        self.assertEqual(count_directory_tags(c, d + os.path.sep,
+                                              names=True),
+                         (2, [('t', 1), ('u', 1)]))
+        self.assertEqual(count_directory_tags(c, os.path.join(d, 'none')),
+                         (0, []))
+
+
+class TestAlias(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from tmsoup import alias
+        alias.init(self.cursor)
+
+    def test_name_cache_sees_tags_created_elsewhere(self):
+        from tmsoup.alias import unknown_symbols
+        from tmsoup.tag import create_tag, rename_tag
+        c = self.cursor
+        self.assertEqual(unknown_symbols(c, ['newtag']), {'newtag'})
+        create_tag(c, 'newtag')
+        self.assertEqual(unknown_symbols(c, ['newtag']), set())
+        rename_tag(c, 'newtag', 'renamed')
+        self.assertEqual(unknown_symbols(c, ['newtag', 'renamed']),
+                         {'newtag'})
+
+
+class TestApplyQueuedTaggings(DatabaseTestCase):
+
+    def test_skips_vanished_files_and_deleted_tags(self):
+        from tmsoup.repair import _apply_queued_taggings
+        from tmsoup.tag import create_tag
+        c = self.cursor
+        t = create_tag(c, 't')
+        kept, removed = self.touch('kept'), os.path.join(self.dir, 'removed')
+        fidmap = {kept: self.add_file(kept), removed: self.add_file(removed),
+                  # known duplicate, but never added to TMSU
+                  os.path.join(self.dir, 'gone'): None}
+        dupes = {'h1': [removed, kept],
+                 'h2': [os.path.join(self.dir, 'gone'), removed]}
+        queue = {'h1': {(t, 0), (999, 0)}, 'h2': {(t, 0)}}
+        _apply_queued_taggings(c, dupes, fidmap, queue, {removed})
+        self.assertEqual(list(c.execute('SELECT file_id, tag_id, value_id'
+                                        ' FROM file_tag')),
+                         [(fidmap[kept], t, 0)])
+
+
+class TestConnectionCached(DatabaseTestCase):
+
+    def test_recomputes_after_changes(self):
+        from tmsoup.util import connection_cached
+        calls = []
+
+        def compute(cursor):
+            calls.append(1)
+            return cursor.execute('SELECT count(*) FROM tag').fetchone()[0]
+
+        c = self.cursor
+        self.assertEqual(connection_cached(c, 'test', compute), 0)
+        self.assertEqual(connection_cached(c, 'test', compute), 0)
+        self.assertEqual(len(calls), 1)
+        c.execute("INSERT INTO tag (name) VALUES ('t')")
+        self.assertEqual(connection_cached(c, 'test', compute), 1)
+        self.assertEqual(len(calls), 2)
+
+    def test_not_shared_between_connections(self):
+        from tmsoup.util import connection_cached
+        other = core.connect(os.path.join(self.dir, 'other.db'))
+        try:
+            self.assertEqual(connection_cached(self.cursor, 'test',
+                                               lambda c: 'a'), 'a')
+            self.assertEqual(connection_cached(other.cursor(), 'test',
+                                               lambda c: 'b'), 'b')
+        finally:
+            other.close()
+
+    def test_forgets_rolled_back_state(self):
+        from tmsoup.tag import tag_id_map
+        from tmsoup.util import batch, do_rollback
+        c = self.cursor
+        c.execute("INSERT INTO tag (name) VALUES ('x')")
+        self.assertEqual(tag_id_map(c), {'x': 1})
+        do_rollback(c)
+        self.assertEqual(tag_id_map(c), {})
+        with self.assertRaises(KeyError):
+            with batch(c):
+                c.execute("INSERT INTO tag (name) VALUES ('y')")
+                self.assertEqual(tag_id_map(c), {'y': 1})
+                raise KeyError('y')
+        self.assertEqual(tag_id_map(c), {})
+
+    def test_holds_connections_weakly(self):
+        import gc
+        import weakref
+        from tmsoup.util import connection_cached
+        other = core.connect(os.path.join(self.dir, 'other.db'))
+        connection_cached(other.cursor(), 'test', lambda c: 'a')
+        ref = weakref.ref(other)
+        other.close()
+        del other
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class TestResolveTagValues(DatabaseTestCase):
+
+    def test_resolve_tag_values(self):
+        from tmsoup.core import resolve_tag_value, resolve_tag_values
+        from tmsoup.tag import create_tag
+        c = self.cursor
+        t = create_tag(c, 't')
+        c.execute("INSERT INTO value (name) VALUES ('v')")
+        v = c.lastrowid
+        pairs = [(t, 0), (t, v), (t, 0)]
+        self.assertEqual(resolve_tag_values(c, pairs),
+                         {(t, 0): 't', (t, v): 't=v'})
+        for tid, vid in pairs:
+            self.assertEqual(resolve_tag_values(c, [(tid, vid)])[tid, vid],
+                             resolve_tag_value(c, tid, vid))
+
+    def test_omits_missing_tags_and_values(self):
+        from tmsoup.core import resolve_tag_values
+        from tmsoup.tag import create_tag
+        t = create_tag(self.cursor, 't')
+        self.assertEqual(resolve_tag_values(self.cursor,
+                                            [(t, 999), (999, 0)]), {})
+        self.assertEqual(resolve_tag_values(self.cursor, []), {})
+
+
+class TestFilePaths(DatabaseTestCase):
+
+    def test_file_infos(self):
+        from tmsoup.file import file_info, file_infos
+        paths = ['a', os.path.join('sub', '..', 'b'), '/abs/c']
+        self.assertEqual(file_infos(paths),
+                         [(self.dir, 'a'), (self.dir, 'b'), ('/abs', 'c')])
+        self.assertEqual(file_infos(paths), [file_info(p) for p in paths])
+
+    def test_file_key(self):
+        from tmsoup.file import file_key
+        self.assertEqual(file_key(self.cursor, 'a'), (self.dir, 'a'))
+        self.assertEqual(file_key(self.cursor, os.path.join(self.dir, 'a')),
+                         (self.dir, 'a'))
+
+    def test_format_mtime(self):
+        from types import SimpleNamespace
+        from tmsoup.file import _format_mtime, file_mtime
+
+        def fmt(ns):
+            return _format_mtime(SimpleNamespace(st_mtime_ns=ns))
+
+        self.assertEqual(fmt(0), '1970-01-01 00:00:00')
+        # 5000ns is .000005, not .5
+        self.assertEqual(fmt(1000005000), '1970-01-01 00:00:01.000005')
+        # no rounding up into the next second
+        self.assertEqual(fmt(86399999999999), '1970-01-01 23:59:59.999999999')
+        path = self.touch('f')
+        os.utime(path, ns=(0, 1500000000))
+        self.assertEqual(file_mtime(path), '1970-01-01 00:00:01.5')
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_sparsehash(self):
+        from hashlib import sha256
+        from unittest import mock
+        from tmsoup import fingerprint
+        data = bytes(range(256)) * 4
+        path = self.write('f', data)
+        with mock.patch.object(fingerprint, 'SPARSE_FINGERPRINT_THRESHOLD',
+                               len(data)), \
+             mock.patch.object(fingerprint, 'SPARSE_FINGERPRINT_SIZE', 100):
+            self.assertEqual(fingerprint.sparsehash(path, sha256),
+                             sha256(data[:100] + data[-100:]).hexdigest())
+            small = self.write('small', data[:-1])
+            self.assertEqual(fingerprint.sparsehash(small, sha256),
+                             sha256(data[:-1]).hexdigest())
+
+    def test_fingerprint_many(self):
+        from tmsoup.fingerprint import fingerprint, fingerprint_many
+        paths = [self.write(str(i), b'x' * i) for i in range(5)]
+        paths += [os.path.join(self.dir, 'missing'), self.dir]
+        expected = {p: fingerprint(p) for p in paths}
+        self.assertIsNone(expected[self.dir])
+        self.assertEqual(fingerprint_many(paths), expected)
+        self.assertEqual(fingerprint_many(paths, 'sha1', workers=1),
+                         {p: fingerprint(p, 'sha1') for p in paths})
+
+
+class TestScanFiles(DatabaseTestCase):
+
+    def test_scan_files(self):
+        from tmsoup.file import file_mtime
+        from tmsoup.repair import scan_files
+        ok, changed = self.touch('ok', b'ok'), self.touch('changed', b'c')
+        missing = os.path.join(self.dir, 'missing')
+        self.add_file(ok, mod_time=file_mtime(ok), size=2)
+        self.add_file(changed, mod_time=file_mtime(changed), size=2)
+        self.add_file(missing)
+        self.add_file(self.dir, mod_time=file_mtime(self.dir), is_dir=True)
+        self.assertEqual(sorted(scan_files(self.cursor)),
+                         [('invalid', changed), ('missing', missing)])
+
+
+class TestDuplicateStats(DatabaseTestCase):
+
+    def test_duplicate_stats(self):
+        from tmsoup.repair import duplicate_stats
+        self.assertEqual(duplicate_stats(self.cursor),
+                         {'sets': 0, 'paths': 0, 'largest': 0})
+        for name, fp in (('a', 'x'), ('b', 'x'), ('c', 'x'),
+                         ('d', 'y'), ('e', 'y'), ('f', 'z'),
+                         # unfingerprinted files are never duplicates
+                         ('g', ''), ('h', '')):
+            self.add_file(os.path.join(self.dir, name), fp)
+        self.assertEqual(duplicate_stats(self.cursor),
+                         {'sets': 2, 'paths': 5, 'largest': 3})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,26 +4,60 @@
 
 import os
 import sys
-import argparse
+from functools import lru_cache
 from .core import (get_db_path, validate_name, connect,
                    tag_names, rename_tag,
-                   KeyExists, tag_id, register_hook, resolve_tag_value)
-from .util import do_commit
+                   KeyExists, register_hook)
+from .util import do_commit, connection_cached
 
-_DB_PATH = get_db_path()
 _autoremoved_aliases = {}
 
-
-def alias_tag_was_deleted(cursor, tagname):
-    tid = tag_id(tagname)
-    aids = set([v[0]
-                for v in cursor.execute(
-                    'SELECT DISTINCT alias_id'
-                    'FROM alias_tag WHERE tag_id = ?').fetchall()])
-    if aids:
-        _autoremoved_aliases.update({k: " ".join(sorted(v[2])) for k, v in
-                                     describe_aliases(cursor).items()
-                                     if v[1] in aids})
+# SQL text for the hot lookups is kept in module constants, so that every call
+# site issues byte-identical statements and hits sqlite3's per-connection
+# prepared statement cache instead of being re-parsed.
+_SQL_ALIAS_TAG_BY_ID = 'SELECT tag_id, value_id FROM alias_tag WHERE alias_id = ?'
+_SQL_ALIAS_ID_BY_NAME = 'SELECT id FROM alias WHERE name = ?'
+_SQL_DESCRIBE_ALIASES = ('SELECT A.id, A.name, T.name, V.name'
+                         ' FROM alias AS A'
+                         ' LEFT JOIN alias_tag AS AT ON AT.alias_id = A.id'
+                         ' LEFT JOIN tag AS T ON T.id = AT.tag_id'
+                         ' LEFT JOIN value AS V ON V.id = AT.value_id'
+                         ' ORDER BY A.name')
+# the tag itself may already be gone, hence the LEFT JOIN on tag.
+_SQL_ALIASES_REFERENCING_TAG = ('SELECT A.name, AT.tag_id, T.name, V.name'
+                                ' FROM alias AS A'
+                                ' JOIN alias_tag AS AT ON AT.alias_id = A.id'
+                                ' LEFT JOIN tag AS T ON T.id = AT.tag_id'
+                                ' LEFT JOIN value AS V ON V.id = AT.value_id'
+                                ' WHERE A.id IN (SELECT alias_id FROM alias_tag'
+                                ' WHERE tag_id = ?)')
+_SQL_RESOLVE_ALIASES = ('SELECT DISTINCT T.name, V.name'
+                        ' FROM alias AS A'
+                        ' JOIN alias_tag AS AT ON AT.alias_id = A.id'
+                        ' JOIN tag AS T ON T.id = AT.tag_id'
+                        ' LEFT JOIN value AS V ON V.id = AT.value_id'
+                        ' WHERE A.name IN (%s)')
+
+
+@lru_cache(maxsize=1)
+def _db_path():
+    """Default database path, looked up on first use rather than at import."""
+    return get_db_path()
+
+
+def alias_tag_was_deleted(cursor, tid, tagname):
+    """'after-tag-delete' hook: record the aliases that referred to the
+    deleted tag (id `tid`, name `tagname`), with their full taggings.
+    """
+    removed = {}
+    for name, atid, tname, vname in cursor.execute(
+            _SQL_ALIASES_REFERENCING_TAG, (tid,)):
+        if atid == tid:
+            tname = tagname
+        removed.setdefault(name, set()).add(
+            tname if vname is None else '%s=%s' % (tname, vname))
+    _autoremoved_aliases.update({k: " ".join(sorted(v))
+                                 for k, v in removed.items()})
 
 
 def init(cursor):
@@ -39,12 +73,15 @@ def init(cursor):
               ' FOREIGN KEY (alias_id) REFERENCES alias(id),'
               ' FOREIGN KEY (tag_id) REFERENCES tag(id),'
               ' FOREIGN KEY (value_id) REFERENCES value(id))')
+    c.execute('CREATE INDEX IF NOT EXISTS'
+              ' idx_alias_tag_alias_id ON alias_tag(alias_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS'
+              ' idx_alias_tag_tag_id ON alias_tag(tag_id)')
     register_hook('after-tag-delete', alias_tag_was_deleted)
 
 
 def db_connect(path=None):
-    import sqlite3
-    conn = connect(path or _DB_PATH)
+    conn = connect(path or _db_path(), bulk=True)
     return conn, conn.cursor()
 
 
@@ -53,44 +90,72 @@ def msg(*args):
 
 
 def alias_names(cursor):
-    return sorted(v[0] for v in cursor.execute('select name from alias'))
+    return [v[0] for v in cursor.execute('select name from alias'
+                                         ' order by name')]
 
 
 def alias_id_map(cursor):
     return dict(cursor.execute('select name, id from alias'))
 
 
+# The name lookups below are repeated several times along a single command's
+# call chain (check_names -> resolve_aliases -> ...). They are cached per
+# connection (see util.connection_cached), so any change to the database,
+# via this module or any other, invalidates them.
+
+def _cached_alias_names(cursor):
+    return connection_cached(cursor, 'alias_names',
+                             lambda c: frozenset(v[0] for v in c.execute(
+                                 'select name from alias')))
+
+
+def _cached_tag_names(cursor):
+    return connection_cached(cursor, 'tag_names',
+                             lambda c: frozenset(tag_names(c)))
+
+
 def resolve_aliases(cursor, items):
-    amap = alias_id_map(cursor)
-    _alias_names = set(amap.keys())
-    c = cursor
-    aliased_items = set(_alias_names).intersection(items)
+    # alias names cannot contain '=', so tag=value items never need the
+    # alias name set to be loaded at all.
+    candidates = [v for v in items if '=' not in v]
+    if not candidates:
+        return items
+
+    aliased_items = _cached_alias_names(cursor).intersection(candidates)
 
     if not aliased_items:
         return items
 
     unaliased_items = set(items).difference(aliased_items)
-    added_taggings = set()
-
-    for a in aliased_items:
-        dest_taggings = list(c.execute('SELECT tag_id, value_id'
-                                       ' FROM alias_tag WHERE'
-                                       ' alias_id = ?', (amap[a],)))
-        added_taggings.update(dest_taggings)
-
-    string_taggings = {resolve_tag_value(c, t, v) for t, v in added_taggings}
+    aliased_items = list(aliased_items)
+    string_taggings = {tname if vname is None else '%s=%s' % (tname, vname)
+                       for tname, vname in cursor.execute(
+                           _SQL_RESOLVE_ALIASES %
+                           ",".join('?' * len(aliased_items)),
+                           aliased_items)}
     string_taggings.update(unaliased_items)
     return sorted(string_taggings)
 
 
+def _name_id_map(cursor, table, names):
+    """Return a name: id map for those of `names` found in `table`
+    ('tag' or 'value'), using a single query."""
+    if table not in ('tag', 'value'):
+        raise ValueError('%r is not a tag/value table' % (table,))
+    if not names:
+        return {}
+    names = list(names)
+    return dict(cursor.execute('SELECT name, id FROM %s WHERE name IN (%s)' %
+                               (table, ",".join('?' * len(names))), names))
+
+
 def alias_id(cursor, name):
-    return cursor.execute('select id from alias'
-                          ' where name = ?', (name,)).fetchone()[0]
+    return cursor.execute(_SQL_ALIAS_ID_BY_NAME, (name,)).fetchone()[0]
 
 
 def check_names(cursor, *names, alias_conflict=True, tag_conflict=True):
-    _alias_names = set(alias_names(cursor))
-    _tag_names = set(tag_names(cursor))
+    _alias_names = _cached_alias_names(cursor)
+    _tag_names = _cached_tag_names(cursor)
     if alias_conflict:
         conflicting_aliases = _alias_names.intersection(names)
         if conflicting_aliases:
@@ -106,17 +171,16 @@ def check_names(cursor, *names, alias_conflict=True, tag_conflict=True):
 
 
 def describe_aliases(cursor):
-    """Return a dict name: (id, taggings) describing every defined alias."""
-    c = cursor
-    desc = {}
-    alias_name = dict(c.execute('SELECT id, name FROM alias'))
-    naliases = len(alias_name)
+    """Return a dict name: (id, taggings) describing every defined alias.
 
-    for id, name in alias_name.items():
-        pairs = list(c.execute('SELECT tag_id, value_id FROM alias_tag'
-                               ' WHERE alias_id=?', (id,)))
-        results = [resolve_tag_value(c, *v) for v in pairs]
-        desc[name] = (id, set(results))
+    The dict is ordered by alias name."""
+    desc = {}
+    for id, name, tname, vname in cursor.execute(_SQL_DESCRIBE_ALIASES):
+        taggings = desc.setdefault(name, (id, set()))[1]
+        if tname is None:
+            # alias with no taggings
+            continue
+        taggings.add(tname if vname is None else '%s=%s' % (tname, vname))
 
     return desc
 
@@ -134,32 +198,43 @@ def aliases_referencing(cursor, tagname):
 def list_aliases(cursor, alias_filter=None, tag_filter=None, oneline=False):
     "Display a list of 'alias > tagging' mappings,"
     " optionally filtered by glob patterns."
-    # XXX collapse aliases with matching RHS,
-    # eg.
-    #
-    # foo -> bar
-    # fool -> bar
-    # >>>>
-    # foo, fool -> bar
-    #
-
+    " Aliases with identical taggings are collapsed onto one line,"
+    " eg. 'foo, fool > bar'."
     import fnmatch
+    import re
+    from collections import defaultdict
+    # translate each glob once, rather than per row
+    alias_match = (re.compile(fnmatch.translate(alias_filter)).match
+                   if alias_filter else None)
+    tag_match = (re.compile(fnmatch.translate(tag_filter)).match
+                 if tag_filter else None)
     descriptions = describe_aliases(cursor)
-    for name, v in sorted(descriptions.items()):
+    groups = defaultdict(list)
+    out = []
+    for name, v in descriptions.items():
         id, tagnames = v
         show = True
 
-        if alias_filter and not fnmatch.fnmatch(name, alias_filter):
+        if alias_match and not alias_match(name):
             show = False
-        elif tag_filter and not any(fnmatch.fnmatch(t, tag_filter)
-                                    for t in tagnames):
+        elif tag_match and not any(tag_match(t) for t in tagnames):
             show = False
 
         if show:
             if oneline:
-                print(name)
+                out.append(name)
             else:
-                print("%20s    > %-20s" % (name, " ".join(tagnames)))
+                groups[frozenset(tagnames)].append(name)
+
+    # names were added in sorted order, so each group's first name sorts it.
+    for tagnames, names in sorted(groups.items(), key=lambda v: v[1][0]):
+        out.append("%20s    > %-20s" % (", ".join(names),
+                                        " ".join(sorted(tagnames))))
+
+    # write the whole listing at once, rather than print()ing each line
+    if out:
+        out.append('')
+        sys.stdout.write("\n".join(out))
 
 
 def alias_tuples(cursor, name, tags):
@@ -183,33 +258,18 @@ def alias_tuples(cursor, name, tags):
 #    print ('AN: %r' % _alias_names)
 #    print ('TN: %s' % (" ".join(_tag_names)))
     tags = resolve_aliases(c, tags)
-    tagval_pairs = []
-    missing_values = set()
-    missing_tags = set()
+    split_tags = []
     for unparsed in tags:
         tmp = unparsed.split('=')
+        split_tags.append((tmp[0], tmp[-1] if len(tmp) > 1 else None))
 
-        if len(tmp) == 1:
-            value_id = 0
-        else:
-            # XXX check value validity here
-            value_id = c.execute('SELECT id FROM value'
-                                 ' WHERE name = ?', (tmp[-1],)).fetchone()
-
-            if value_id is None:
-                missing_values.add(tmp[1])
-            else:
-                value_id = value_id[0]
-
-        tag_id = c.execute('SELECT id FROM tag'
-                           ' WHERE name = ?', (tmp[0],)).fetchone()
-
-        if tag_id is None:
-            missing_tags.add(tmp[0])
-        else:
-            tag_id = tag_id[0]
-
-        tagval_pairs.append((tag_id, value_id))
+    tag_map = _name_id_map(c, 'tag', {t for t, v in split_tags})
+    value_map = _name_id_map(c, 'value',
+                             {v for t, v in split_tags if v is not None})
+    value_map[None] = 0
+    missing_tags = {t for t, v in split_tags}.difference(tag_map)
+    missing_values = {v for t, v in split_tags}.difference(value_map)
+    tagval_pairs = [(tag_map.get(t), value_map.get(v)) for t, v in split_tags]
 
     if missing_tags:
         raise KeyError('The following tags do not'
@@ -222,7 +282,13 @@ def alias_tuples(cursor, name, tags):
     return tagval_pairs
 
 
-def add_alias(cursor, name, tags):
+def add_alias(cursor, name, tags, commit=True):
+    """Add alias `name`, mapping to the given tags/aliases.
+
+    The alias row and its taggings are inserted in a single transaction.
+    Pass commit=False when adding several aliases, and do_commit() once
+    afterwards.
+    """
     validate_name(name)
     try:
         pairs = alias_tuples(cursor, name, tags)
@@ -233,23 +299,23 @@ def add_alias(cursor, name, tags):
     msg(name, ':', pairs)
 
     c.execute('insert into alias(name) values (?)', (name,))
-    do_commit(cursor)
-    new_alias_id = alias_id(c, name)
+    new_alias_id = c.lastrowid
     msg('new alias id: %r' % new_alias_id)
 
-    for tag_id, value_id in pairs:
-        c.execute('insert into alias_tag (alias_id, tag_id, value_id)'
-                  ' values (?, ?, ?)', (new_alias_id, tag_id, value_id))
+    c.executemany('insert into alias_tag (alias_id, tag_id, value_id)'
+                  ' values (?, ?, ?)',
+                  [(new_alias_id, tag_id, value_id)
+                   for tag_id, value_id in pairs])
 
-    do_commit(cursor)
+    if commit:
+        do_commit(cursor)
 
 
-def check_aliases():
-    conn = db_connect()
-    c = conn.cursor()
-    _alias_names = alias_names()
-    tag_ids = {v[0] for v in c.execute('SELECT id FROM tag').fetchall()}
-    value_ids = {v[0] for v in c.execute('SELECT id FROM value').fetchall()}
+def check_aliases(cursor):
+    c = cursor
+    _alias_names = alias_names(c)
+    tag_ids = {v[0] for v in c.execute('SELECT id FROM tag')}
+    value_ids = {v[0] for v in c.execute('SELECT id FROM value')}
     value_ids.add(0)
     unknown_values = set()
     unknown_tags = set()
@@ -257,12 +323,11 @@ def check_aliases():
 
     for name in _alias_names:
         validate_name(name)
-        alias_id = get_alias_id(name)
-        data = c.execute('SELECT tag_id, value_id'
-                         ' FROM alias_tag WHERE alias_id=?', (alias_id,))
-        data = list(data.fetchall())
-        these_tag_ids = {d[0] for d in data}
-        these_value_ids = {d[1] for d in data}
+        these_tag_ids = set()
+        these_value_ids = set()
+        for t, v in c.execute(_SQL_ALIAS_TAG_BY_ID, (alias_id(c, name),)):
+            these_tag_ids.add(t)
+            these_value_ids.add(v)
         missing_tags = these_tag_ids.difference(tag_ids)
         missing_values = these_value_ids.difference(value_ids)
 
@@ -297,7 +362,7 @@ def check_aliases():
 def copy_alias(cursor, name, *destnames):
     for dest in destnames:
         validate_name(dest)
-    _alias_names = alias_names(cursor)
+    _alias_names = _cached_alias_names(cursor)
 
     if name not in _alias_names:
         raise KeyError('Attempt to copy nonexistent alias %r' % name)
@@ -306,13 +371,14 @@ def copy_alias(cursor, name, *destnames):
     tagset = resolve_aliases(cursor, [name])
 
     for newname in destnames:
-        add_alias(cursor, newname, tagset)
+        add_alias(cursor, newname, tagset, commit=False)
+    do_commit(cursor)
 
 
 def alias_away(cursor, oldname, newname, path=None):
     validate_name(newname)
-    _alias_names = alias_names(cursor)
-    _tag_names = tag_names(cursor)
+    _alias_names = _cached_alias_names(cursor)
+    _tag_names = _cached_tag_names(cursor)
 
     if oldname not in _tag_names:
         raise KeyError('Tried to alias away tag %r,'
@@ -328,7 +394,7 @@ def alias_away(cursor, oldname, newname, path=None):
     from subprocess import call
 
     rename_tag(cursor, oldname, newname)
-    _tag_names = tag_names(cursor)
+    _tag_names = _cached_tag_names(cursor)
 
     if oldname in _tag_names or newname not in tag_names:
         raise ValueError('Renaming tag %r -> %r  failed!' %
@@ -345,7 +411,7 @@ def alias_away(cursor, oldname, newname, path=None):
 
 def rename_alias(cursor, oldname, newname):
     from .core import rename
-    _tag_names = tag_names(cursor)
+    _tag_names = _cached_tag_names(cursor)
 
     if newname in _tag_names:
         raise KeyExists('tag', newname)
@@ -356,25 +422,27 @@ def rename_alias(cursor, oldname, newname):
     do_commit(cursor)
 
 
-def delete_alias(cursor, name):
+def delete_alias(cursor, name, commit=True):
     c = cursor
-    if not any(c.execute('SELECT name FROM alias WHERE name = ?', (name,))):
+    _alias_id = c.execute(_SQL_ALIAS_ID_BY_NAME, (name,)).fetchone()
+    if _alias_id is None:
         raise KeyError('Tried to remove alias %r, but'
                        ' no such alias exists!' % name)
 
-    _alias_id = alias_id(c, name)
+    _alias_id = _alias_id[0]
     c.execute('delete from alias_tag where alias_id = ?', (_alias_id,))
     c.execute('delete from alias where id = ?', (_alias_id,))
-    do_commit(cursor)
+    if commit:
+        do_commit(cursor)
 
 
-def unknown_symbols(symbols, reverse=False):
+def unknown_symbols(cursor, symbols, reverse=False):
     """Return the set of all symbols that are not yet known.
 
     That is, symbols that do not match a tag name or alias name.
     """
-    available_symbols = set(alias_names())
-    available_symbols.update(tag_names())
+    available_symbols = (_cached_alias_names(cursor) |
+                         _cached_tag_names(cursor))
     symbols_to_check = {s.split('=', 1)[0] for s in symbols}
     if reverse:
         return symbols_to_check.intersection(available_symbols)
@@ -382,6 +450,7 @@ def unknown_symbols(symbols, reverse=False):
 
 
 def parse_args(args):
+    import argparse
     parser = argparse.ArgumentParser(description=
                                      'Simple alias CLI tool for TMSU')
     parser.add_argument('-v', '--verbose', default=False, action='store_true',
@@ -463,16 +532,88 @@ def parse_args(args):
     return parser.parse_args(args)
 
 
+_COMMA_TO_SPACE = str.maketrans(',', ' ')
+
+
 def uncomma(tags):
     """Convert a list of tags which may include
     single tags and foo,bar,baz groups of tags, into uniform
     single tags"""
-    import re
-    return re.split('[ ,]+', " ".join(tags))
+    return " ".join(tags).translate(_COMMA_TO_SPACE).split()
+
+
+def _cmd_list(cursor, args):
+    list_aliases(cursor, args.name, args.aliased_to, args.oneline)
+
+
+def _cmd_add(cursor, args):
+    add_alias(cursor, args.aliasname, uncomma(args.tagname))
+
+
+def _cmd_multi_add(cursor, args):
+    tagset = uncomma(args.tags)
+
+    for aliasname in args.aliasname:
+        add_alias(cursor, aliasname, tagset, commit=False)
+    do_commit(cursor)
+
+
+def _cmd_rename(cursor, args):
+    rename_alias(cursor, args.oldname, args.newname)
+
+
+def _cmd_copy(cursor, args):
+    copy_alias(cursor, args.source, *args.dest)
+
+
+def _cmd_resolve(cursor, args):
+    # make sure any foo,bar,baz are properly handled
+    # rather than treating them as a single tag/alias name.
+    names = uncomma(args.name)
+    print(" ".join(resolve_aliases(cursor, names)))
+
+
+def _cmd_away(cursor, args):
+    alias_away(cursor, args.oldname, args.newname)
+
+
+def _cmd_remove(cursor, args):
+    for name in args.aliasname:
+        delete_alias(cursor, name, commit=False)
+    do_commit(cursor)
+
+
+def _cmd_unknown(cursor, args):
+    items = unknown_symbols(cursor, args.symbol)
+    print(" ".join(sorted(items)))
+
+
+def _cmd_known(cursor, args):
+    items = unknown_symbols(cursor, args.symbol, True)
+    print(" ".join(sorted(items)))
+
+
+def _cmd_check(cursor, args):
+    check_aliases(cursor)
+
+
+_DISPATCH = {'list': _cmd_list,
+             'add': _cmd_add,
+             'multi_add': _cmd_multi_add,
+             'rename': _cmd_rename,
+             'copy': _cmd_copy,
+             'resolve': _cmd_resolve,
+             'away': _cmd_away,
+             'remove': _cmd_remove,
+             'unknown': _cmd_unknown,
+             'known': _cmd_known,
+             'check': _cmd_check}
+_DISPATCH['ls'] = _DISPATCH['list']
+_DISPATCH['res'] = _DISPATCH['resolve']
+_DISPATCH['rm'] = _DISPATCH['remove']
 
 
 def main(arguments, cursor=None):
-    import re
     args = parse_args(arguments)
     c = args.command
 
@@ -481,46 +622,17 @@ def main(arguments, cursor=None):
     else:
         print('using default database', file=sys.stderr)
 
+    try:
+        command = _DISPATCH[c]
+    except KeyError:
+        raise ValueError('Something weird happened,'
+                         ' this line should never be reached.')
+
     if not cursor:
         print ('making own cursor')
         _, cursor = db_connect(args.database)
     init(cursor)
-
-    if c in ('list', 'ls'):
-        list_aliases(cursor, args.name, args.aliased_to, args.oneline)
-    elif c == 'add':
-        add_alias(cursor, args.aliasname, uncomma(args.tagname))
-    elif c == 'multi_add':
-        import re
-        tagset = uncomma(args.tags)
-
-        for aliasname in args.aliasname:
-            add_alias(cursor, aliasname, tagset)
-    elif c == 'rename':
-        rename_alias(cursor, args.oldname, args.newname)
-    elif c == 'copy':
-        copy_alias(cursor, args.source, *args.dest)
-    elif c in ('resolve', 'res'):
-        # make sure any foo,bar,baz are properly handled
-        # rather than treating them as a single tag/alias name.
-        names = uncomma(args.name)
-        print(" ".join(resolve_aliases(cursor, names)))
-    elif c == 'away':
-        alias_away(cursor, args.oldname, args.newname)
-    elif c in ('remove', 'rm'):
-        for name in args.aliasname:
-            delete_alias(cursor, name)
-    elif c == 'unknown':
-        items = unknown_symbols(cursor, args.symbol)
-        print(" ".join(sorted(items)))
-    elif c == 'known':
-        items = unknown_symbols(cursor, args.symbol, True)
-        print(" ".join(sorted(items)))
-    elif c == 'check':
-        check_aliases(cursor)
-    else:
-        raise ValueError('Something weird happened,'
-                         ' this line should never be reached.')
+    command(cursor, args)
 
 
 
@@ -4,15 +4,23 @@
 
 import os
 import sys
-import argparse
 import re
-from .core import (get_db_path, connect, validate_name,
+from functools import lru_cache
+from .core import (get_db_path, connect, set_bulk_pragmas, validate_name,
                    tag_names, rename_tag,
                    KeyExists, tag_id, register_hook, resolve_tag_value)
 from .util import do_commit
 
 
-_DB_PATH = get_db_path()
+@lru_cache(maxsize=1)
+def _db_path():
+    """Default database path, looked up on first use rather than at import."""
+    return get_db_path()
+
+
+# A token is a maximal run of characters other than space and comma.
+_TOKEN_RE = re.compile('[^ ,]+')
+_TAGID_RE = re.compile('\\{#([0-9]+)\\}')
 
 
 def init(cursor):
@@ -32,7 +40,8 @@ def init(cursor):
 
 def db_connect(path=None):
     import sqlite3
-    conn = sqlite3.connect(path or _DB_PATH)
+    conn = sqlite3.connect(path or _db_path())
+    set_bulk_pragmas(conn)
     return conn, conn.cursor()
 
 
@@ -149,12 +158,12 @@ def tagnames_to_tagids(cursor, ann_text):
     from .tag import tag_id_map
     map = tag_id_map(cursor)
     def encode(m):
-        main = m.expand('\\2')
-        if main in map:
-            return m.expand('\\1{#%d}') % map[main]
-        return m.expand('\\1\\2')
+        token = m.group()
+        if token in map:
+            return '{#%d}' % map[token]
+        return token
 
-    return re.sub('(^|[ ,])([^ ,]+)(?=$|[ ,])', encode, ann_text)
+    return _TOKEN_RE.sub(encode, ann_text)
 
 def tagids_to_tagnames(cursor, ann_text):
     """Convert tag id codes '{#123}' -> 'foo' in the annotation text, for display.
@@ -162,7 +171,11 @@ def tagids_to_tagnames(cursor, ann_text):
     """
     from .tag import id_tag_map
     map = id_tag_map(cursor)
-    return re.sub("\{#([0-9]+)\}", lambda m: map.get(int(m.expand('\\1')), '{#%s?}' % m.expand('\\1')), ann_text)
+    def decode(m):
+        id = m.group(1)
+        return map.get(int(id), '{#%s?}' % id)
+
+    return _TAGID_RE.sub(decode, ann_text)
 
 def parse_args(_args):
     from argparse import ArgumentParser
@@ -191,9 +204,9 @@ def main(args):
     cursor = conn.cursor()
     init(cursor)
     if arg.command == 'add':
-        from itertools import groupby
-        annotation_tuples = tuple(tuple(v[1]) for v in groupby(arg.annotation, lambda k:arg.annotation.index(k) // 2))
-        annotation_tuples = [(parse_roi(v[0]), v[1]) for v in annotation_tuples]
+        # pair up consecutive ROI, TEXT arguments
+        it = iter(arg.annotation)
+        annotation_tuples = [(parse_roi(roi), text) for roi, text in zip(it, it)]
         print ('add got %r ' % (annotation_tuples,))
         arg.path = arg.path
         print('path is %r' % arg.path)
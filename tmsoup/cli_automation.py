@@ -11,6 +11,8 @@ you want just by importing the relevant modules.
 
 """
 
+import weakref
+
 _registry = {}
 
 # XXX need a way to improve CLI help so it includes automation
@@ -31,14 +33,14 @@ def register(subcommands, cli_executor):
 
     Notes
     ======
-    Subcommand names are case-folded;
+    Subcommand names are case-folded (str.casefold());
     eg. 'Untag' and 'UNTAG' are the same subcommand.
 
     """
     if isinstance(subcommands, str):
         subcommands = [subcommands]
-    for subc in subcommmands:
-        subc = subc.lower()
+    for subc in subcommands:
+        subc = subc.casefold()
         if subc in _registry:
             raise ValueError('Attempt to register subcommand {} -> {},'
                              ' which would conflict with existing'
@@ -60,11 +62,11 @@ def unregister(subcommands, must_exist=True):
     if isinstance(subcommands, str):
         subcommands = [subcommands]
     for subc in subcommands:
-        subc = subc.lower()
+        subc = subc.casefold()
         if subc in _registry:
             del _registry[subc]
-        elif not must_exist:
-            raise KeyError('Executor for {} not registered.')
+        elif must_exist:
+            raise KeyError('Executor for {} not registered.'.format(subc))
 
 
 def automate(shared_args, args, cursor=None):
@@ -72,14 +74,93 @@ def automate(shared_args, args, cursor=None):
     dispatch to the correct sub-CLI-handler, based
     on args[0] value.
     """
-    dispatch_on = args[0].lower()
-    if dispatch_on not in _registry:
+    dispatch_on = args[0].casefold()
+    func = _registry.get(dispatch_on)
+    if func is None:
         raise ValueError('unknown subcommand {}'.format(dispatch_on))
-    used_args = shared_args + args
-    func = _registry[dispatch_on]
+    # executors get a single list; with no shared args, args is
+    # passed through as-is rather than copied.
+    if shared_args:
+        used_args = list(shared_args)
+        used_args.extend(args)
+    else:
+        used_args = args
     func(used_args, subcommand_id=dispatch_on, cursor=cursor)
 
 
+class _ArgReader:
+    """Chunked reader used by read_args().
+
+    Reads `file` (text or binary) in large chunks, and finds the end of
+    each argument sequence with str.find()/bytes.find(), rather than
+    examining one character per read() call.
+
+    Data read past the end of a sequence stays in the buffer for the
+    next call, so the underlying file is never seek()ed.
+    """
+
+    def __init__(self, file, chunksize=65536):
+        self.file = file
+        self.chunksize = chunksize
+        self.buf = None
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Read another chunk, discarding already-consumed data."""
+        chunk = self.file.read(self.chunksize)
+        if self.buf is None:
+            self.buf = chunk
+        else:
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        if not chunk:
+            self.eof = True
+
+    def read_sequence(self):
+        """Return (text, is_eof) for the next argument sequence."""
+        if self.buf is None:
+            self._fill()
+        nl = '\n' if isinstance(self.buf, str) else b'\n'
+        # how far past self.pos has already been searched
+        scanned = 0
+        while True:
+            if self.buf[self.pos:self.pos + 1] == nl:
+                # blank line at the start of a sequence; empty sequence.
+                self.pos += 1
+                return self.buf[:0], False
+            idx = self.buf.find(nl + nl, self.pos + scanned)
+            if idx != -1:
+                # keep the newline ending the last argument,
+                # drop the blank line.
+                text = self.buf[self.pos:idx + 1]
+                self.pos = idx + 2
+                return text, False
+            if self.eof:
+                text = self.buf[self.pos:]
+                self.pos = len(self.buf)
+                return text, True
+            scanned = max(0, len(self.buf) - self.pos - 1)
+            self._fill()
+
+    def read_args(self):
+        """Return (arguments, is_eof) for the next argument sequence.
+
+        The sequence text is decoded in one go (rather than per argument)
+        and then split on newlines directly."""
+        text, eof = self.read_sequence()
+        if not text:
+            return [], eof
+        if not isinstance(text, str):
+            text = text.decode('utf-8')
+        if text.endswith('\n'):
+            text = text[:-1]
+        return text.split('\n'), eof
+
+
+_readers = weakref.WeakKeyDictionary()
+
+
 def read_args(file):
     """Read a sequence of arguments from file.
 
@@ -103,28 +184,17 @@ def read_args(file):
         '
         Expresses two argument sequences, each containing two arguments.
 
-    After calling read_args(), the file cursor will be either at the
-    beginning of a new argument sequence, or at EOF.
-
-    This function is somewhat slow. It could be improved using array('u'),
-    probably. It must not use seek(), in order to support reading from stdin.
+    After calling read_args(), the next call to read_args() on the same file
+    will return the following argument sequence.
+    Note that `file` is read ahead in large chunks, which are buffered
+    between calls; don't read from `file` by other means in the meantime.
+    It never uses seek(), in order to support reading from stdin.
+    Binary files are decoded as UTF-8.
     """
-    text = []
-    eof = False
-    c = 'dummy'
-    while c:
-        c = f.read(1)
-        if c:
-            # newline immediately followed by newline?
-            # end of this commandline.
-            if not (c == '\n' and (not text or text[-1] == '\n')):
-                text.append(c)
-            else:
-                break
-        else: # EOF
-            eof = True
-            break
-    return ("".join(text)).splitlines(), eof
+    reader = _readers.get(file)
+    if reader is None:
+        reader = _readers[file] = _ArgReader(file)
+    return reader.read_args()
 
 
 def parse_file(file):
@@ -189,13 +259,14 @@ def parse_file(file):
     if you don't have any shared args.)
 
     """
-    eof = False
-    shared_args, eof = read_args(file)
-    if eof:
-        raise
+    reader = _readers.get(file)
+    if reader is None:
+        reader = _readers[file] = _ArgReader(file)
+    shared_args, eof = reader.read_args()
+    shared_args = tuple(shared_args)
 
     while not eof:
-        args, eof = read_args(file)
+        args, eof = reader.read_args()
         # ignore empty commands (no args)
         # this allows you to separate commands by as many blank lines
         # as desired.
@@ -223,16 +294,42 @@ def get_cursor(parsed_args):
     parsed_args.database = get_db_path(parsed_args.database)
 
 
+_shared_parser = None
+
+def _get_shared_parser():
+    global _shared_parser
+    if _shared_parser is None:
+        import argparse
+        parser = argparse.ArgumentParser('CLI Automation for tmsoup')
+        add_shared_options(parser)
+        _shared_parser = parser
+    return _shared_parser
+
+
 def parse_shared_args(args):
-    parser = argparse.ArgumentParser('CLI Automation for tmsoup')
-    add_shared_options(parser)
-    return parser.parse_known_args(args)
+    return _get_shared_parser().parse_known_args(args)
+
 
+def automate_from_file(file, single_transaction=False, cursor=None):
+    """Parse and dispatch a complete file
 
-def automate_from_file(file, single_transaction=False):
-    """Parse and dispatch a complete file"""
-    for shared, args in parse_file(file):
-        automate(shared, args)
+    If single_transaction is True, every command runs inside one
+    transaction on `cursor`'s connection (which must then be given),
+    committed at the end, or rolled back if any command fails.
+    The write lock is taken up front (BEGIN IMMEDIATE), so the run can't
+    fail part-way because another process started writing.
+    """
+    if not single_transaction:
+        for shared, args in parse_file(file):
+            automate(shared, args, cursor=cursor)
+        return
+
+    from .util import batch
+    if cursor is None:
+        raise ValueError('single_transaction requires a cursor')
+    with batch(cursor):
+        for shared, args in parse_file(file):
+            automate(shared, args, cursor=cursor)
 
 
 if __name__ == "__main__":
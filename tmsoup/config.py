@@ -1,6 +1,15 @@
+from .util import connection_cached
+
+
+def _load_settings(cursor):
+    return dict(cursor.execute('select name, value from setting'))
+
+
 def get_config(cursor, key, default=None):
-    val = cursor.execute('select value from setting where name = ?', 
-          (key,)).fetchone()
-    if val is None:
-        return default
-    return val[0]
+    """Return the value of setting `key`, or default if it is not set.
+
+    The whole setting table is read at once, and cached per connection
+    (see util.connection_cached).
+    """
+    return connection_cached(cursor, 'settings', _load_settings).get(key,
+                                                                     default)
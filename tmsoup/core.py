@@ -1,12 +1,11 @@
 import os
-import sys
 import sqlite3
-from functools import partial
+from functools import lru_cache, partial
 from .file import (delete_file_taggings, file_info, file_id, file_ids,
-                  file_mtime)
+                   file_mtime, _MAX_IN_PARAMS)
 from .tag import (create_tag, delete_tag, rename_tag, tag_names, tag_id,
                   id_tag_map, tag_id_map)
-from .util import (rename, delete, validate_name, do_commit)
+from .util import (rename, delete, validate_name, do_commit, do_rollback)
 
 
 class KeyExists(Exception):
@@ -27,18 +26,23 @@ def register_hook(role, callback):
 
     Valid roles:
 
-    after-tag-delete
+    after-tag-delete    callback(cursor, tag_id, tag_name), called once
+                        the tag's row has been deleted.
     """
-    if role not in _registry:
-        _registry[role] = []
-    if callback not in _registry[role]:
-        _registry[role].append(callback)
+    # callbacks are stored as tuples, replaced on registration, so that
+    # a callback registering another hook can't disturb a dispatch.
+    callbacks = _registry.get(role, ())
+    if callback not in callbacks:
+        _registry[role] = callbacks + (callback,)
 
 
 def dispatch_hook(role, *args, **kwargs):
     """Call all registered callback hooks for the specified role.
     """
-    for callback in _registry.get(role, []):
+    callbacks = _registry.get(role)
+    if not callbacks:
+        return
+    for callback in callbacks:
         callback(*args, **kwargs)
 
 
@@ -51,6 +55,38 @@ def _abspath(path):
     return tmp
 
 
+# path: .tmsu/db found for it. Misses aren't cached, since a database may be
+# created (eg. by `tmsu init`) later in the same process.
+_local_dbs = {}
+
+
+def _find_local_db(path):
+    # Return the deepest .tmsu/db at or above absolute path `path`
+    # (the root directory itself is only checked when path is the root),
+    # or None.
+    found = _local_dbs.get(path)
+    if found is None:
+        found = _search_local_db(path)
+        if found is not None:
+            if len(_local_dbs) >= 256:
+                _local_dbs.clear()
+            _local_dbs[path] = found
+    return found
+
+
+def _search_local_db(path):
+    candidate = os.path.join(path, '.tmsu', 'db')
+    if os.path.isfile(candidate):
+        return candidate
+    parent = os.path.dirname(path)
+    while os.path.dirname(parent) != parent:
+        candidate = os.path.join(parent, '.tmsu', 'db')
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(parent)
+    return None
+
+
 def get_db_path(path=None, basedir=None):
     """Make a best guess at correct db path,
     given a nominal path (which can be None), and an optional basedir.
@@ -92,15 +128,9 @@ def get_db_path(path=None, basedir=None):
             basedir = os.getcwd()
             if not os.path.exists(basedir):
                 raise FileNotFoundError('cwd %r no longer exists!' % basedir)
-        path = os.path.abspath(basedir)
-        parts = path.split(os.path.sep)
-        candidate = os.path.sep + os.path.join(*(parts + ['.tmsu/db']))
-        if os.path.isfile(candidate):
+        candidate = _find_local_db(os.path.abspath(basedir))
+        if candidate:
             return candidate
-        for i in range(-1, -(len(parts) - 1), -1):
-            candidate = os.path.sep + os.path.join(*(parts[:i] + ['.tmsu/db']))
-            if os.path.isfile(candidate):
-                return candidate
         lasttry = os.getenv('TMSU_DB', None)
         if not lasttry:
             lasttry = os.path.expanduser('~/.tmsu/default.db')
@@ -131,7 +161,28 @@ def relpath(database):
     return None
 
 
-def connect(database, *args, **kwargs):
+@lru_cache(maxsize=4096)
+def _relative_dir(root, directory):
+    return os.path.relpath(directory, root)
+
+
+def _relative_to(root, path):
+    # os.path.relpath(path, root) for absolute `path`,
+    # with the (costly) directory part cached, since batches of paths
+    # usually share a handful of directories.
+    directory, name = os.path.split(path)
+    if not name or path == root:
+        return os.path.relpath(path, root)
+    reldir = _relative_dir(root, directory)
+    if reldir == os.curdir:
+        return name
+    if os.path.basename(reldir) == os.pardir:
+        # directory is an ancestor of root, so `name` may cancel a '..'
+        return os.path.relpath(path, root)
+    return os.path.join(reldir, name)
+
+
+def connect(database, *args, bulk=False, **kwargs):
     """Connect to database, initializing it if it doesn't exist.
 
     The custom Connection instance returned provides the following
@@ -147,6 +198,12 @@ def connect(database, *args, **kwargs):
         _relpath : cached value of relpath(database).
                    Used in path normalization
 
+    Pass bulk=True to tune the connection for bulk work
+    (see set_bulk_pragmas()); note this switches the database to
+    WAL journalling, permanently.
+    Unless given, cached_statements defaults to 256; pass
+    cached_statements=0 to disable sqlite3's statement cache.
+
     Memory-only databases (database - ':memory:') are currently not supported.
 
     """
@@ -154,12 +211,14 @@ def connect(database, *args, **kwargs):
         _relpath = relpath(database)
         def normalize_path(self, p):
             if self._relpath:
-                p2 = os.path.abspath(p)
-                return os.path.relpath(p2, self._relpath)
+                return _relative_to(self._relpath, os.path.abspath(p))
             else:
                 return os.path.abspath(p)
 
     exists = os.path.exists(database)
+    # room for every fixed statement used by tmsoup, plus the per-length
+    # IN (...) lists of the batched lookups.
+    kwargs.setdefault('cached_statements', 256)
     conn = sqlite3.connect(database, *args, factory=TMSUConnection, **kwargs)
     if not exists:
         conn.cursor().executescript("""
@@ -214,13 +273,39 @@ CREATE TABLE setting (
                 value TEXT NOT NULL
             );
 """)
+    if bulk:
+        set_bulk_pragmas(conn)
+    return conn
+
+
+# journal_mode=WAL is persistent (recorded in the database file);
+# the others only apply to the current connection.
+_BULK_PRAGMAS = ('PRAGMA journal_mode=WAL',
+                 'PRAGMA synchronous=NORMAL',
+                 'PRAGMA temp_store=MEMORY',
+                 'PRAGMA cache_size=-65536',
+                 'PRAGMA mmap_size=268435456')
+
+
+def set_bulk_pragmas(conn):
+    """Tune a connection for CLI runs that issue many statements:
+    WAL journalling, relaxed fsync, in-memory temp tables,
+    a 64MiB page cache and memory-mapped reads.
+
+    Returns conn.
+
+    Note that WAL journalling is recorded in the database file,
+    so it persists for every later user of the database, including TMSU.
+    """
+    for pragma in _BULK_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
 def tag_values(cursor):
     """Return a list of all tag values defined in this database"""
-    return list(v[0] for v in cursor.execute('SELECT name FROM value'
-                                             ' ORDER BY name').fetchall())
+    return [name for (name,) in cursor.execute('SELECT name FROM value'
+                                               ' ORDER BY name')]
 
 
 def resolve_tag_value(cursor, tagid, valueid):
@@ -230,41 +315,58 @@ def resolve_tag_value(cursor, tagid, valueid):
     else:
         tmp = cursor.execute('SELECT T.name,V.name FROM tag AS T,'
                              ' value AS V where T.id=? and V.id=?',
-                             (tagid, valueid)).fetchall()[0]
+                             (tagid, valueid)).fetchone()
         return '%s=%s' % tmp
 
 
+def resolve_tag_values(cursor, pairs):
+    """Return a (tag_id, value_id): 'tag' or 'tag=value' map
+    for each of the given (tag_id, value_id) pairs,
+    as resolve_tag_value() would, but using one query per few hundred pairs.
+
+    Pairs that refer to nonexistent tags or values are omitted.
+    """
+    pairs = list(set(pairs))
+    result = {}
+    step = _MAX_IN_PARAMS // 2
+    for i in range(0, len(pairs), step):
+        chunk = pairs[i:i + step]
+        params = [v for pair in chunk for v in pair]
+        for tid, vid, tname, vname in cursor.execute(
+                'WITH pairs(tid, vid) AS (VALUES %s)'
+                ' SELECT P.tid, P.vid, T.name, V.name FROM pairs AS P'
+                ' JOIN tag AS T ON T.id = P.tid'
+                ' LEFT JOIN value AS V ON V.id = P.vid' %
+                ','.join(['(?,?)'] * len(chunk)), params):
+            if vid == 0:
+                result[(tid, vid)] = tname
+            elif vname is not None:
+                result[(tid, vid)] = '%s=%s' % (tname, vname)
+    return result
+
+
 
 def file_tags(cursor, paths):
-    """Return path,  tags tuples for each of the specified paths/ids.
+    """Return a path: [(tag_id, value_id), ...] map for each of the specified paths.
 
+    Paths not known to TMSU map to an empty list.
     """
-    # XXX could be faster -- query all paths in one go
-    id_path_map = {}
-    map = {}
-    for p in paths:
-        _id = file_id(cursor, p)
-        if _id is not None:
-            id_path_map[_id] = p
-        else:
-            # Not known to TMSU yet
-            map[p] = []
-    cursor.execute('CREATE TEMPORARY TABLE fileidtmp(id INTEGER)')
-    idlist = sorted(id_path_map.keys())
-    sys.stderr.write('id_path_map is %r\n' % (id_path_map,))
-
-    for start in range(0, len(idlist) + 1, 499):
-        tmp = idlist[start:start+499]
-        if tmp:
-            cursor.execute('INSERT INTO fileidtmp VALUES {}'.format(
-                ", ".join("(%d)" % v for v in tmp)))
-    for fid, tid, vid in cursor.execute('SELECT F.file_id,'
-                             ' F.tag_id,'
-                             ' F.value_id'
-                             ' FROM file_tag AS F JOIN fileidtmp AS I'
-                             ' ON F.file_id = I.id'):
-        map.setdefault(id_path_map[fid],[]).append((tid, vid))
-    cursor.execute('DROP TABLE fileidtmp')
+    paths = list(paths)
+    map = {p: [] for p in paths}
+    idpaths = {}
+    for p, fid in file_ids(cursor, paths).items():
+        if fid is not None:
+            idpaths.setdefault(fid, []).append(p)
+    ids = list(idpaths)
+    for i in range(0, len(ids), _MAX_IN_PARAMS):
+        chunk = ids[i:i + _MAX_IN_PARAMS]
+        for fid, tid, vid in cursor.execute('SELECT file_id, tag_id, value_id'
+                                            ' FROM file_tag'
+                                            ' WHERE file_id IN (%s)' %
+                                            ','.join('?' * len(chunk)),
+                                            chunk):
+            for p in idpaths[fid]:
+                map[p].append((tid, vid))
     return map
 
 
@@ -274,13 +376,10 @@ def tag_files(cursor, fids, taggings):
     with the given taggings -- (tag_id, value_id) pairs.
 
     """
-    all_values = []
-    for fid in fids:
-        all_values.extend((fid, tid, vid) for tid, vid in taggings)
-    all_values = ",".join("(%d,%d,%d)" % v for v in all_values)
-    sys.stderr.write('%r\n' % all_values)
-    cursor.execute('replace into file_tag(file_id, tag_id, value_id)'
-        ' values %s' % all_values)
+    cursor.executemany('replace into file_tag(file_id, tag_id, value_id)'
+                       ' values (?, ?, ?)',
+                       [(fid, tid, vid) for fid in fids
+                        for tid, vid in taggings])
     do_commit(cursor)
 
 def untag_files(cursor, fids, taggings):
@@ -293,32 +392,28 @@ def untag_files(cursor, fids, taggings):
 
     """
 
-    if any(type(v) != int for v in fids):
+    # bools are rejected too: type(True) is bool, not int.
+    bad = [v for v in fids if type(v) is not int]
+    if bad:
         raise ValueError('All file ids must be integers, not [' +
-            ("".join(str(type(v)) for v in fids if type(v) != int)) + "]")
+            ("".join(str(type(v)) for v in bad)) + "]")
 
-    if any(len(v) != 2 for v in taggings):
+    bad = [v for v in taggings if len(v) != 2]
+    if bad:
         raise ValueError('All taggings must be 2-tuples (tagid, valueid),'
-            ' not %r' % ([v for v in taggings if len(v) != 2],))
+            ' not %r' % (bad,))
 
-    cursor.execute('CREATE TEMPORARY TABLE fileidtmp(id INTEGER)')
-    idlist = ",".join(['(%d)' % v for v in fids])
-    cursor.execute('INSERT INTO fileidtmp VALUES %s' % idlist)
     max_affected = len(fids) * len(taggings)
     # XXX this is not as well error-checked as TMSU's code
     # (storage/database/filetag.go:DeleteFileTag())
-    do_commit(cursor)
-    total_affected = 0
-    for params in taggings:
-        cursor.execute('DELETE FROM file_tag'
-            ' WHERE file_id IN (select * from fileidtmp)'
-            ' AND tag_id = ? AND value_id = ?)', params)
-        if cursor.rowcount > max_affected:
-            cursor.rollback()
-            raise IOError('Too many rows (%d > max %d) affected'
-                ' by deletion' % (cursor.rowcount, max_affected))
-        total_affected += cursor.rowcount
-    cursor.execute('DROP TABLE fileidtmp')
+    cursor.executemany('DELETE FROM file_tag'
+                       ' WHERE file_id = ? AND tag_id = ? AND value_id = ?',
+                       [(fid, tid, vid) for fid in fids
+                        for tid, vid in taggings])
+    total_affected = cursor.rowcount
+    if total_affected > max_affected:
+        do_rollback(cursor, IOError('Too many rows (%d > max %d) affected'
+            ' by deletion' % (total_affected, max_affected)))
     do_commit(cursor)
     return total_affected
 
@@ -352,5 +447,6 @@ __all__ = ('validate_name', 'get_db_path', 'tag_names', 'tag_values',
            'tag_id_map', 'id_tag_map', 'rename_tag', 'delete_tag',
            'register_hook', 'dispatch_hook', 'KeyExists', 'file_id',
            'file_ids', 'file_tags', 'tag_files', 'untag_files',
-           'delete_file_tag', 'connect',
-           'delete_file_taggings', 'splitpath', 'resolve_tag_value')
+           'delete_file_tag', 'connect', 'set_bulk_pragmas',
+           'delete_file_taggings', 'splitpath', 'resolve_tag_value',
+           'resolve_tag_values')
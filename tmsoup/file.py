@@ -2,6 +2,9 @@ import os
 import time
 from .util import do_commit
 
+_MAX_IN_PARAMS = 900
+
+
 def delete_file_taggings(cursor, file_id):
     """Delete all taggings relating to a specific file_id
 
@@ -27,7 +30,24 @@ def file_info(path):
     Use os.path.realpath() before passing the path to file_info,
     if that is what you need.
     """
-    return os.path.split(os.path.abspath(path))
+    return file_infos([path])[0]
+
+
+def file_infos(paths):
+    """Return a list of file_info() tuples, one for each of paths.
+
+    Prefer this to calling file_info() in a loop: os.getcwd() is only
+    called once, rather than once per relative path.
+    """
+    cwd = os.getcwd()
+    isabs, join, normpath, split = (os.path.isabs, os.path.join,
+                                    os.path.normpath, os.path.split)
+    out = []
+    for p in paths:
+        if not isabs(p):
+            p = join(cwd, p)
+        out.append(split(normpath(p)))
+    return out
 
 
 def file_mtime(path):
@@ -38,18 +58,44 @@ def file_mtime(path):
     Trailing zeros are truncated, to match TMSU's implementation.
     If nanoseconds == 0, the decimal part is omitted entirely.
     """
-    base = os.stat(path)
-    t = time.gmtime(base.st_mtime)
-    nano = base.st_mtime_ns % 1000000000
-    if nano > 0:
-        nano = str(nano)
-        while nano[-1] == '0':
-            nano = nano[:-1]
-        nano = '.' + nano
-    else:
-        nano = ''
+    return _format_mtime(os.stat(path))
+
+
+def _format_mtime(st):
+    """file_mtime(), given an os.stat() result instead of a path."""
+    # split the integer timestamp, rather than using the float st_mtime,
+    # which can round up into the next second.
+    secs, nano = divmod(st.st_mtime_ns, 1000000000)
+    t = time.gmtime(secs)
+    # nanoseconds are zero-padded to 9 digits before trailing zeros go,
+    # so eg. 5000ns is '.000005'.
+    frac = ('.%09d' % nano).rstrip('0') if nano else ''
+    return '%04d-%02d-%02d %02d:%02d:%02d%s' % (t.tm_year, t.tm_mon, t.tm_mday,
+                                                t.tm_hour, t.tm_min, t.tm_sec,
+                                                frac)
+
+
+def file_key(cursor, path):
+    """Return the (directory, name) tuple identifying path in the `file` table
+    of the database cursor is connected to.
+
+    Paths are normalized via cursor.connection.normalize_path() when
+    available (see tmsoup.core.connect()); otherwise file_info() is used.
+    """
+    if hasattr(cursor.connection, 'normalize_path'):
+        return os.path.split(cursor.connection.normalize_path(path))
+    return file_info(path)
+
 
-    return time.strftime('%Y-%m-%d %H:%M:%S' + nano, t)
+def _bulk_file_keys(cursor, paths):
+    """Return a list of file_key() tuples, one for each of paths."""
+    infos = file_infos(paths)
+    if not hasattr(cursor.connection, 'normalize_path'):
+        return infos
+    # Paths are already absolute, so normalize_path() won't hit getcwd().
+    normalize, join, split = (cursor.connection.normalize_path,
+                              os.path.join, os.path.split)
+    return [split(normalize(join(d, n))) for d, n in infos]
 
 
 def file_id(cursor, path):
@@ -57,15 +103,7 @@ def file_id(cursor, path):
 
     If the path is not yet tagged, return None.
     """
-    if hasattr(cursor.connection, 'normalize_path'):
-        print('normalizing %r' % path)
-        print('relpath = %r' % cursor.connection._relpath)
-        np = cursor.connection.normalize_path(path)
-        print('normpath = %r' % np)
-        dirname, filename = os.path.split(np)
-        print('->%r %r' % (dirname, filename))
-    else:
-        dirname, filename = file_info(path)
+    dirname, filename = file_key(cursor, path)
     results = list(cursor.execute('SELECT id FROM file'
                   ' WHERE directory=? AND name=?', (dirname, filename)))
     if len(results) > 1:
@@ -76,9 +114,28 @@ def file_id(cursor, path):
 
 
 def file_ids(cursor, paths):
-    """Return a path: file.id map for the given paths."""
-    # XXX is slow?
-    return {p: file_id(cursor, p) for p in paths}
+    """Return a path: file.id map for the given paths.
+
+    Paths that are not yet tagged map to None.
+    """
+    from collections import defaultdict
+    paths = list(paths)
+    bydir = defaultdict(dict)
+    for p, (dirname, filename) in zip(paths, _bulk_file_keys(cursor, paths)):
+        bydir[dirname].setdefault(filename, []).append(p)
+    result = dict.fromkeys(paths)
+    # one query per directory, keeping under SQLite's 999-parameter limit.
+    for dirname, names in bydir.items():
+        names = list(names.items())
+        for i in range(0, len(names), _MAX_IN_PARAMS):
+            chunk = dict(names[i:i + _MAX_IN_PARAMS])
+            for name, id in cursor.execute(
+                    'SELECT name, id FROM file WHERE directory = ?'
+                    ' AND name IN (%s)' % ','.join('?' * len(chunk)),
+                    [dirname] + list(chunk)):
+                for p in chunk[name]:
+                    result[p] = id
+    return result
 
 
 def dir_contains(path, querypath):
@@ -139,6 +196,11 @@ def rename_path(cursor, oldpath, newpath, update_only=False):
                     but /foo/baz doesn't exist.)
     FileNotFoundError   If oldpath doesn't exist on disk, and you haven't
                         specified update_only=True.
+    NotImplementedError If oldpath is not a directory; renaming files
+                        is not supported yet.
+
+    Errors are raised without rolling anything back; the caller's
+    transaction (if any) decides what happens to it.
 
 
     """
@@ -148,13 +210,14 @@ def rename_path(cursor, oldpath, newpath, update_only=False):
     oldpath = os.path.abspath(oldpath)
     newpath = os.path.abspath(newpath)
     isdir = os.path.isdir(oldpath) or os.path.isdir(os.path.realpath(oldpath))
-    db_isdir = cursor.execute('SELECT is_dir FROM file'
-                              ' WHERE directory = ? AND name = ?',
-                              file_info(oldpath)).fetchone()
-    if db_isdir:
-        db_isdir = db_isdir[0]
+    # the path's own row (if it is tagged) is looked up only once.
+    row = cursor.execute('SELECT id, is_dir FROM file'
+                         ' WHERE directory = ? AND name = ?',
+                         file_info(oldpath)).fetchone()
+    if row:
+        id, db_isdir = row
     else:
-        db_isdir = isdir
+        id, db_isdir = None, isdir
 
     if isdir != db_isdir:
         raise OSError('OS reports isdir=%r,'
@@ -167,11 +230,7 @@ def rename_path(cursor, oldpath, newpath, update_only=False):
                               oldpath,
                               os.path.dirname(newpath),
                               os.path.basename(newpath)))
-        id = cursor.execute('SELECT id FROM file'
-                            ' WHERE directory=? AND name = ?',
-                            file_info(oldpath)).fetchone()
-        if id:
-            id = id[0]
+        root_id = id
         pattern = oldpath + os.path.sep + '%'
         idmap = {}
         for id, directory in cursor.execute('SELECT id, directory FROM file'
@@ -180,40 +239,30 @@ def rename_path(cursor, oldpath, newpath, update_only=False):
                                             (oldpath, pattern)):
 
             if dir_contains(oldpath, directory):
-                tmp = directory.split(oldpath, 1)
-                if len(tmp) != 2:
-                    raise ValueError('Attempted to split %r by %r,'
-                                     ' but got %r!' % (directory,
-                                                       oldpath,
-                                                       tmp))
-                tmp[0] = newpath
-                rewritten = "".join(tmp)
-                import sys
-                print ('%r -> %r' % (directory, rewritten), file=sys.stderr)
-                idmap[id] = (directory, rewritten)
+                if not directory.startswith(oldpath):
+                    # only possible for a non-normalized stored directory
+                    raise ValueError('%r is inside %r, but does not'
+                                     ' start with it!' % (directory,
+                                                          oldpath))
+                idmap[id] = (directory, newpath + directory[len(oldpath):])
             elif directory == oldpath:
                 idmap[id] = (oldpath, newpath)
-        print ('idmap: %r' % (idmap,))
-        # XXX actually make changes.
-    else:
-        import sys
-        sys.exit(1)
-        # blocked off for now.
-        id = cursor.execute('SELECT id FROM file'
-                            ' WHERE directory=? AND name = ?',
-                            file_info(oldpath)).fetchone()
-        if not id:
-            raise KeyError('No record referring to %r found.' % (oldpath,))
-        id = id[0]
         if not update_only:
-            newdir = os.path.dirname(newpath)
-            if not os.path.exists(newpath):
-                raise OSError('Attempt to move {} into a nonexistent'
-                              ' directory {}'.format(oldpath, newdir))
+            # renamed on disk before any row is written, so that if it fails,
+            # the database (and the caller's transaction) is left untouched.
             os.rename(oldpath, newpath)
-        cursor.execute('UPDATE file SET directory=?, name=? WHERE id=?',
-                       file_info(newpath) + (id,))
-        do_commit()
+        cursor.executemany('UPDATE file SET directory=? WHERE id=?',
+                           [(new, id) for id, (old, new) in idmap.items()])
+        n = len(idmap)
+        if root_id is not None:
+            cursor.execute('UPDATE file SET directory=?, name=? WHERE id=?',
+                           file_info(newpath) + (root_id,))
+            n += 1
+        do_commit(cursor)
+        return n
+    else:
+        # blocked off for now.
+        raise NotImplementedError('tmsoup.file.rename_path() on a file')
 
 
 def move_paths(cursor, paths, destdir):
@@ -245,16 +294,16 @@ def parse_args(args):
 
 def main(argv):
     import sqlite3
-    from tmsoup.core import get_db_path
+    from tmsoup.core import get_db_path, set_bulk_pragmas
     args = parse_args(argv)
-    conn = sqlite3.connect(get_db_path())
+    conn = set_bulk_pragmas(sqlite3.connect(get_db_path()))
     cursor = conn.cursor()
     if not os.path.isdir(args.oldname):
         raise ValueError('directories only, for now.')
     rename_path(cursor, args.oldname, args.newname)
 
 __all__ = ('delete_file_taggings', 'file_id', 'file_ids', 'file_mtime',
-           'file_info')
+           'file_info', 'file_infos', 'file_key')
 
 if __name__ == '__main__':
     import sys
@@ -5,6 +5,7 @@ from hashlib import sha1, sha256, md5
 
 SPARSE_FINGERPRINT_THRESHOLD = 5 * 1024 * 1024
 SPARSE_FINGERPRINT_SIZE = 512 * 1024
+FULLHASH_CHUNK_SIZE = 1024 * 1024
 
 CONFIG_KEY = 'fingerprintAlgorithm'
 DEFAULT_ALGORITHM = 'dynamic:SHA256'
@@ -25,6 +26,21 @@ def fingerprint(path, algorithm=None):
     data = func(path)
     return data
 
+def fingerprint_many(paths, algorithm=None, workers=8):
+    """Return a path: fingerprint map, as fingerprint() would produce
+    for each of the given paths.
+
+    Files are hashed by a pool of `workers` threads; hashlib releases
+    the GIL while hashing, so this overlaps both I/O and hashing.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    paths = list(paths)
+    if len(paths) < 2 or workers < 2:
+        return {p: fingerprint(p, algorithm) for p in paths}
+    with ThreadPoolExecutor(workers) as ex:
+        return dict(zip(paths, ex.map(lambda p: fingerprint(p, algorithm),
+                                      paths)))
+
 def get_fingerprint_algorithm(cursor):
     """Return the fingerprinting algorithm configured for the given database.
     
@@ -50,12 +66,14 @@ def set_fingerprint_algorithm(cursor, algo):
 
 def fullhash(path, hasher):
     hasher = hasher()
-    with open(path, 'rb') as f:
-        chunk = 'dummy'
-        while chunk:
-            chunk = f.read(0xffff)
-            if chunk:
-                hasher.update(chunk)
+    # one reusable buffer; unbuffered reads go straight into it.
+    buf = bytearray(FULLHASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        n = f.readinto(buf)
+        while n:
+            hasher.update(view[:n])
+            n = f.readinto(buf)
     return hasher.hexdigest()
 
 
@@ -64,13 +82,18 @@ def sparsehash(path, hasher):
     if size < SPARSE_FINGERPRINT_THRESHOLD:
         return fullhash(path, hasher)
 
+    # as TMSU: hash the first and last SPARSE_FINGERPRINT_SIZE bytes.
     hasher = hasher()
-    with open(path, 'rb') as f:
-        chunk = f.read(SPARSE_FINGERPRINT_SIZE)
-        hasher.update(chunk)
+    buf = bytearray(SPARSE_FINGERPRINT_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        n = f.readinto(buf)
+        hasher.update(view[:n])
         f.seek(size - SPARSE_FINGERPRINT_SIZE)
+        n = f.readinto(buf)
+        hasher.update(view[:n])
+    return hasher.hexdigest()
 
-    
 
 def fp_sha256(path):
     return fullhash(path, sha256)
@@ -123,4 +146,4 @@ fingerprinters = {'dynamic:SHA256': fp_dynamic_sha256,
                   'symlinkTargetName': fp_symlink_targetname,
                   'symlinkTargetNameNoExt': fp_symlink_targetname_noext}
 
-__all__ = ('fingerprint', 'fingerprinters')
+__all__ = ('fingerprint', 'fingerprint_many', 'fingerprinters')
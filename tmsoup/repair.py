@@ -1,17 +1,83 @@
 import os
-import glob
 import re
 import sys
-from .core import (splitpath, KeyExists,
-                   file_mtime, file_ids, file_tags,
-                   file_info, resolve_tag_value)
+from functools import lru_cache
+from stat import S_ISDIR
+from .core import (splitpath, KeyExists, set_bulk_pragmas,
+                   file_mtime, file_ids, file_tags, tag_files,
+                   delete_file_taggings, resolve_tag_values)
 from .fingerprint import (set_fingerprint_algorithm,
                           get_fingerprint_algorithm,
-                          fingerprint)
-from .util import do_commit
+                          fingerprint, fingerprint_many)
+from .file import _format_mtime, file_infos, _MAX_IN_PARAMS
+from .util import do_commit, do_rollback, batch
 
 INVALID_SIZE = -1
 
+
+class _ListdirEntry:
+    # The subset of os.DirEntry used here, for Pythons older than 3.5.
+    # Every method costs a syscall, unlike DirEntry's cached d_type.
+    __slots__ = ('name', 'path')
+
+    def __init__(self, dir, name):
+        self.name = name
+        self.path = os.path.join(dir, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _listdir_scandir(path):
+    return [_ListdirEntry(path, name) for name in os.listdir(path)]
+
+
+# os.scandir() is new in Python 3.5.
+_scandir = getattr(os, 'scandir', _listdir_scandir)
+
+def _missing_names(dir, names):
+    """Generate those of names that do not exist in directory dir.
+
+    dir is listed once, instead of stat()ing each name.
+    """
+    try:
+        entries = {e.name: e for e in _scandir(dir or os.curdir)}
+    except (FileNotFoundError, NotADirectoryError):
+        entries = {}
+    except OSError:
+        # eg. unreadable directory; fall back to checking each path.
+        entries = None
+    for name in names:
+        p = os.path.join(dir, name)
+        if entries is None:
+            if not os.path.exists(p):
+                yield name
+            continue
+        e = entries.get(name)
+        # symlinks must be followed, as os.path.exists() does.
+        if e is None or (e.is_symlink() and not os.path.exists(p)):
+            yield name
+
+
+def _existing_paths(paths):
+    """Return the set of those paths that exist on disk."""
+    bydir = {}
+    for p in paths:
+        dir, name = os.path.split(p)
+        bydir.setdefault(dir, []).append(name)
+    existing = set(paths)
+    for dir, names in bydir.items():
+        existing.difference_update(os.path.join(dir, name)
+                                   for name in _missing_names(dir, names))
+    return existing
+
+
 def unknown_paths(cursor):
     """Generate a list of all paths referenced in the database that cannot be found on disk.
 
@@ -20,10 +86,14 @@ def unknown_paths(cursor):
     This only checks the existence of paths.
 
     """
-    for dir, name in cursor.execute('select directory, name from file'):
-        p = os.path.join(dir, name)
-        if not os.path.exists(p):
-            yield p
+    from itertools import groupby
+    from operator import itemgetter
+    # one directory listing per directory, instead of one stat() per path.
+    rows = cursor.execute('select directory, name from file'
+                          ' order by directory')
+    for dir, group in groupby(rows, itemgetter(0)):
+        for name in _missing_names(dir, [name for _, name in group]):
+            yield os.path.join(dir, name)
 
 
 def invalidated_paths(cursor):
@@ -38,19 +108,30 @@ def invalidated_paths(cursor):
     invalidated_paths() returns only paths that exist on disk.
     Use unknown_paths() if you need a list of paths that do not.
     """
+    for kind, p in scan_files(cursor):
+        if kind == 'invalid':
+            yield p
+
+
+def scan_files(cursor):
+    """Generate ('missing', path) and ('invalid', path) tuples,
+    covering what unknown_paths() and invalidated_paths() report,
+    from a single pass over the file table.
+
+    Use this when both are needed: each path is stat()ed only once.
+    """
     for dir, name, size, mtime in cursor.execute('select directory, name, size, mod_time'
-        ' from file'):
+        ' from file order by directory'):
         p = os.path.join(dir, name)
+        # one stat() per path covers existence, isdir, size and mtime.
         try:
-            realsize = 0 if os.path.isdir(p) else os.path.getsize(p)
-        except FileNotFoundError:
+            st = os.stat(p)
+        except (FileNotFoundError, NotADirectoryError):
+            yield ('missing', p)
             continue
-        if realsize != size:
-            yield p
-            continue
-        realmtime = file_mtime(p)
-        if realmtime != mtime:
-            yield p
+        realsize = 0 if S_ISDIR(st.st_mode) else st.st_size
+        if realsize != size or _format_mtime(st) != mtime:
+            yield ('invalid', p)
 
 
 def duplicated_paths(cursor):
@@ -61,22 +142,37 @@ def duplicated_paths(cursor):
     Some of the paths may refer to files that no longer exist. It is left as an exercise for the
     caller to choose whether to filter out sets where only 1 path in the set actually exists.
     """
-    from collections import Counter
-    counter = Counter()
-
-    counter.update(v[0] for v in cursor.execute('select fingerprint from file'))
-    duplicated = {fp for fp, count in counter.items() if count > 1 and fp}
-    print('ndupes = %d' % len(duplicated), file=sys.stderr)
     duplicates = {}
-    for dir, name, fingerprint in cursor.execute('select directory,'
-        ' name, fingerprint from file'):
-        if fingerprint in duplicated:
-            p = os.path.join(dir, name)
-            group = duplicates.setdefault(fingerprint, [])
-            group.append(p)
+    # the grouping is done by SQLite, using idx_file_fingerprint.
+    for dir, name, fp in cursor.execute('select directory,'
+        ' name, fingerprint from file where fingerprint in'
+        ' (select fingerprint from file where fingerprint != \'\''
+        ' group by fingerprint having count(*) > 1)'):
+        p = os.path.join(dir, name)
+        group = duplicates.setdefault(fp, [])
+        group.append(p)
+    print('ndupes = %d' % len(duplicates), file=sys.stderr)
     return duplicates
 
 
+def duplicate_stats(cursor):
+    """Return a dict summarizing duplicated paths, as duplicated_paths() would find them:
+
+    sets        the number of fingerprints shared by more than one path
+    paths       the total number of paths in those sets
+    largest     the number of paths in the largest set
+
+    This is computed entirely by SQLite; the filesystem is not examined,
+    so paths that no longer exist on disk are counted.
+    """
+    sets, paths, largest = cursor.execute('select count(*), total(n), max(n)'
+        ' from (select count(*) as n from file where fingerprint != \'\''
+        ' group by fingerprint having n > 1)').fetchone()
+    return {'sets': sets, 'paths': int(paths), 'largest': largest or 0}
+
+
+_WORD_RE = re.compile('\\b[A-Za-z][a-z]{2,30}\\b')
+
 # some example fd scores:
 #
 # 'foo bar' -> 3*3*2 -> 18
@@ -87,12 +183,11 @@ def duplicated_paths(cursor):
 #
 def _filename_descriptiveness(filename):
     filename = os.path.splitext(filename)[0]
-    words = re.findall('\\b[A-Za-z][a-z]{2,30}\\b', filename)
-    return sum(len(v) * len(v) for v in words)
+    return sum([len(v) * len(v) for v in _WORD_RE.findall(filename)])
 
 # A linearly interpolated function, peaking at c=30 -> 2.0 multiplier and clipped on each end
 
-def _filecount_multiplier(c):
+def _filecount_multiplier_impl(c):
     if c <= 10:
         return max(0.1, 1.3 * (c / 10))
     elif c <= 30:
@@ -100,8 +195,28 @@ def _filecount_multiplier(c):
     else:
         return 2.0 - (1.75 * (min(c - 30, 170) / 170))
 
+# file counts are small ints, and the function is flat beyond c=200.
+_FCM = tuple(_filecount_multiplier_impl(c) for c in range(201))
+
+def _filecount_multiplier(c):
+    if c >= 200:
+        return _FCM[200]
+    return _FCM[c]
+
+
+@lru_cache(maxsize=4096)
+def _count_files(dirname):
+    # Count the non-directory entries of dirname, skipping dotfiles
+    # (as glob's '*' does). DirEntry.is_dir() usually needs no stat().
+    # Cached (bounded), as each directory is visited once per duplicate in it.
+    try:
+        return sum(1 for e in _scandir(dirname)
+                   if not e.name.startswith('.') and not e.is_dir())
+    except OSError:
+        return 0
 
-def value_of_duplicate(path, path_cache = {}):
+
+def value_of_duplicate(path):
     """Ranks a duplicate, returning a score value for it.
 
     Ranking is based on:
@@ -114,11 +229,7 @@ def value_of_duplicate(path, path_cache = {}):
       * the immediate parent directory factors into score. Directories above that do not.
     """
     dirname = os.path.dirname(path)
-    if dirname in path_cache:
-        nfiles = path_cache[dirname]
-    else:
-        nfiles = sum(1 for p in glob.glob(os.path.join(dirname, '*')) if not os.path.isdir(p))
-        path_cache[dirname] = nfiles
+    nfiles = _count_files(dirname)
     base = os.path.basename(path)
     if '?' in base:
         base = base.split('?', 1)[0]
@@ -134,9 +245,25 @@ def rank_duplicates(dupes):
 
     Ordering is by 'categorizability' and 'filename quality'.
     """
-    return {k: sorted(v, key = value_of_duplicate) for k, v in dupes.items()}
+    from concurrent.futures import ThreadPoolExecutor
+    # count each directory's files up front, overlapping the listings,
+    # so the sorts below only hit the _count_files() cache.
+    paths = {p for paths in dupes.values() for p in paths}
+    dirs = {os.path.dirname(p) for p in paths}
+    if len(dirs) > 1:
+        with ThreadPoolExecutor(8) as ex:
+            for _ in ex.map(_count_files, dirs):
+                pass
+    # a path listed under several fingerprints is only scored once.
+    scores = {p: value_of_duplicate(p) for p in paths}
+    return {k: sorted(v, key=scores.__getitem__) for k, v in dupes.items()}
+
 
 
+# shared by both lookups in repair_path(), so they reuse one cached statement.
+_FILE_BY_PATH_SQL = ('select id, is_dir, fingerprint from file'
+                     ' where directory = ? and name = ?')
+
 
 def repair_path(cursor, oldpath, newpath, ignore_fingerprint=False):
     """Repair a single path in the database.
@@ -157,19 +284,16 @@ def repair_path(cursor, oldpath, newpath, ignore_fingerprint=False):
     if not os.path.exists(newpath):
         raise FileNotFoundError(newpath)
     odirname, obasename = splitpath(oldpath)
-    tmp = cursor.execute('select id, is_dir, fingerprint from file'
-                         ' where directory = ?, name = ?',
-                         (odirname, obasename)).fetchone()
+    tmp = cursor.execute(_FILE_BY_PATH_SQL, (odirname, obasename)).fetchone()
 
     if tmp is None:
         raise KeyError('No `file` record found for path %r' % oldpath)
 
     ndirname, nbasename = splitpath(newpath)
-    if cursor.execute('select is_dir from file where directory = ?, name = ?',
-                      (ndirname, nbasename)).fetchone():
+    if cursor.execute(_FILE_BY_PATH_SQL, (ndirname, nbasename)).fetchone():
         raise KeyExists('file', newpath)
 
-    id, isdir, fp = tmp[0]
+    id, isdir, fp = tmp
     isdir = (isdir != 0)
     new_isdir = os.path.isdir(newpath)
     if new_isdir != isdir:
@@ -178,8 +302,8 @@ def repair_path(cursor, oldpath, newpath, ignore_fingerprint=False):
                              new_isdir,
                              newpath))
 
-    new_fp = fingerprint(cursor, get_fingerprint_algorithm(cursor))
-    if new_fp != fp:
+    new_fp = fingerprint(newpath, get_fingerprint_algorithm(cursor))
+    if new_fp != fp and not ignore_fingerprint:
         raise ValueError('Recorded hash {} does not match hash {}'
                          ' of new path {}'.format(fp, new_fp, newpath))
     cursor.execute('UPDATE file SET directory = ?, name = ? WHERE id = ?',
@@ -189,6 +313,82 @@ def repair_path(cursor, oldpath, newpath, ignore_fingerprint=False):
     assert (type(fp) == str)
 
 
+def _file_records(cursor, keys):
+    """Return a (directory, name): (id, is_dir, fingerprint, mod_time) map
+    for those of the given (directory, name) keys that have a `file` record,
+    using one query per few hundred keys.
+    """
+    keys = list(set(keys))
+    records = {}
+    step = _MAX_IN_PARAMS // 2
+    for i in range(0, len(keys), step):
+        chunk = keys[i:i + step]
+        params = [v for key in chunk for v in key]
+        for dirname, name, id, is_dir, fp, mtime in cursor.execute(
+                'WITH paths(directory, name) AS (VALUES %s)'
+                ' SELECT F.directory, F.name, F.id, F.is_dir, F.fingerprint,'
+                ' F.mod_time FROM paths AS P JOIN file AS F'
+                ' ON F.directory = P.directory AND F.name = P.name' %
+                ','.join(['(?,?)'] * len(chunk)), params):
+            records[(dirname, name)] = (id, is_dir, fp, mtime)
+    return records
+
+
+def repair_paths(cursor, pairs, ignore_fingerprint=False):
+    """Repair many paths in the database, as repair_path() would
+    for each (oldpath, newpath) pair.
+
+    Every pair is checked before any record is changed, and all the
+    changes are committed together; if any pair fails a check, nothing
+    is changed.
+
+    Raises
+    =======
+    ValueError      if two pairs have the same newpath.
+    As repair_path(), for the first pair that fails a check.
+    """
+    pairs = list(pairs)
+    oldkeys = [splitpath(old) for old, new in pairs]
+    newkeys = [splitpath(new) for old, new in pairs]
+    if len(set(newkeys)) != len(newkeys):
+        from collections import Counter
+        dupes = sorted(os.path.join(*k) for k, n in Counter(newkeys).items()
+                       if n > 1)
+        raise ValueError('More than one path would be renamed to each of'
+                         ' %r' % (dupes,))
+    for oldpath, newpath in pairs:
+        if not os.path.exists(newpath):
+            raise FileNotFoundError(newpath)
+    records = _file_records(cursor, oldkeys + newkeys)
+    if not ignore_fingerprint:
+        fps = fingerprint_many([new for old, new in pairs],
+                               get_fingerprint_algorithm(cursor))
+
+    updates = []
+    for (oldpath, newpath), okey, nkey in zip(pairs, oldkeys, newkeys):
+        if okey not in records:
+            raise KeyError('No `file` record found for path %r' % oldpath)
+        if nkey in records:
+            raise KeyExists('file', newpath)
+        id, isdir, fp, _ = records[okey]
+        isdir = (isdir != 0)
+        new_isdir = os.path.isdir(newpath)
+        if new_isdir != isdir:
+            raise ValueError('Recorded isdir={} does not match'
+                             'isdir={} of new path {}'.format(isdir,
+                                 new_isdir,
+                                 newpath))
+        if not ignore_fingerprint and fps[newpath] != fp:
+            raise ValueError('Recorded hash {} does not match hash {}'
+                             ' of new path {}'.format(fp, fps[newpath],
+                                                      newpath))
+        updates.append(nkey + (id,))
+    cursor.executemany('UPDATE file SET directory = ?, name = ? WHERE id = ?',
+                       updates)
+    do_commit(cursor)
+    return len(updates)
+
+
 def merge_files(cursor, main_file_id, *dupes):
     """Merge file ids specifieds in *dupes with main_file_id.
 
@@ -203,13 +403,12 @@ def change_fingerprint_algorithm(cursor, algorithm):
     try:
         set_fingerprint_algorithm(cursor, algorithm)
     except ValueError:
-        cursor.connection.rollback()
+        do_rollback(cursor)
     cursor.execute('UPDATE file SET size = -1')
     do_commit(cursor)
 
 
 def _msg(*args,**kwargs):
-    import sys
     print(*args, file=sys.stderr, **kwargs)
 
 
@@ -243,7 +442,8 @@ def changed_paths(cursor):
     have the same mtime but different fingerprints.
 
     """
-    import sys
+    from itertools import groupby
+    from operator import itemgetter
     i = 0
     modified = []
     broken = []
@@ -252,41 +452,58 @@ def changed_paths(cursor):
     badmtime = []
     linkres = []
 
-    for dirname, filename, omtime, isdir in \
-        cursor.execute('SELECT directory, name, mod_time,'
-                       ' is_dir'
-                       ' FROM file'):
-        i += 1
-        if (i % 100) == 0:
-            sys.stderr.write('%08d\r' % i)
-        p = os.path.join(dirname, filename)
-        realp = os.path.realpath(p)
-
-        if os.path.islink(p) and not os.path.exists(p):
-            broken.append(p)
-            continue
-        elif not os.path.exists(p):
-            deleted.append(p)
-            continue
-        elif realp != p:
-            linkres.append(p)
-
-        mtime = file_mtime(p)
-
-        opos = omtime.find('.')
-        pos = mtime.find('.')
-        trunc_eq = omtime[:opos] == mtime[:pos]
-
-        # time differs by <1s. Probably an incorrect record.
-        if trunc_eq and not (omtime == mtime):
-            badmtime.append(p)
-            omtime=mtime
-
-        if omtime != mtime:
-            modified.append(p)
-        isdir = (isdir != 0)
-        if isdir != os.path.isdir(p):
-            kind.append(p)
+    # one directory listing per directory, then at most one stat() per path
+    # (plus a realpath() for symlinks), instead of ~5 syscalls per path.
+    rows = cursor.execute('SELECT directory, name, mod_time,'
+                          ' is_dir'
+                          ' FROM file ORDER BY directory')
+    for dirname, group in groupby(rows, itemgetter(0)):
+        try:
+            entries = {e.name: e for e in _scandir(dirname or os.curdir)}
+        except (FileNotFoundError, NotADirectoryError):
+            entries = {}
+        except OSError:
+            # eg. unreadable directory; fall back to checking each path.
+            entries = None
+        # a symlinked ancestor makes every path in here resolve elsewhere.
+        dir_resolves = os.path.realpath(dirname) != dirname
+        for _, filename, omtime, isdir in group:
+            i += 1
+            if (i % 100) == 0:
+                sys.stderr.write('%08d\r' % i)
+            p = os.path.join(dirname, filename)
+            if entries is None:
+                e = None
+                islink = os.path.islink(p)
+            else:
+                e = entries.get(filename)
+                if e is None:
+                    deleted.append(p)
+                    continue
+                islink = e.is_symlink()
+
+            try:
+                st = e.stat() if e is not None else os.stat(p)
+            except OSError:
+                (broken if islink else deleted).append(p)
+                continue
+            if dir_resolves or (islink and os.path.realpath(p) != p):
+                linkres.append(p)
+
+            mtime = _format_mtime(st)
+
+            # most records are unchanged; only slice the ones that aren't.
+            if omtime != mtime:
+                opos = omtime.find('.')
+                pos = mtime.find('.')
+                # time differs by <1s. Probably an incorrect record.
+                if omtime[:opos] == mtime[:pos]:
+                    badmtime.append(p)
+                else:
+                    modified.append(p)
+            isdir = (isdir != 0)
+            if isdir != S_ISDIR(st.st_mode):
+                kind.append(p)
 
     return {'modified' : modified,
             'broken': broken,
@@ -307,18 +524,19 @@ def update_file_metadata(cursor, paths):
                 was a file, or vice versa.
     IOError     when the number of results for a given path is not exactly 1.
     """
+    paths = list(paths)
+    keys = dict(zip(paths, file_infos(paths)))
+    # look up all the records first, a few hundred paths per query.
+    records = _file_records(cursor, keys.values())
+
     old_info = {}
     for p in paths:
-        finf = file_info(p)
-        tmp = cursor.execute('SELECT is_dir, fingerprint, mod_time'
-                             ' FROM file'
-                             ' WHERE directory = ? AND name = ?',
-                             finf).fetchone()
+        tmp = records.get(keys[p])
         if not tmp:
             raise IOError('Expected 1 row for {},'
-                          ' but got {}'.format(p, cursor.rowcount))
+                          ' but got 0'.format(p))
 
-        is_dir, fp, mtime = tmp
+        _, is_dir, fp, mtime = tmp
         old_info[p] = (fp, mtime)
         is_dir = (is_dir != 0)
         now_is_dir = os.path.isdir(p)
@@ -327,11 +545,8 @@ def update_file_metadata(cursor, paths):
                               is_dir, now_is_dir))
     # okay, nothing looks hinky, let's recalculate
     algo = get_fingerprint_algorithm(cursor)
-    updated = {}
-    for p in paths:
-        fp = fingerprint(p, algo)
-        mtime = file_mtime(p)
-        updated[p] = (fp, mtime)
+    fps = fingerprint_many(paths, algo)
+    updated = {p: (fps[p], file_mtime(p)) for p in paths}
     # we don't actually update the database yet, just show our work.
     print('Recalculated values:')
     print('\n'.join('%s %s %s' % (v[0], v[1], k) for k,v in updated.items()))
@@ -339,6 +554,50 @@ def update_file_metadata(cursor, paths):
     print('\n'.join(k for k, v in updated.items() if v != old_info[k]))
 
 
+def _formatted_taggings(cursor, taggings):
+    names = resolve_tag_values(cursor, taggings)
+    # a queued tag or value may have been deleted in the meantime.
+    return " ".join(names.get(v, '<deleted %r>' % (v,)) for v in taggings)
+
+
+def _apply_queued_taggings(cursor, dupes, fidmap,
+                           tagging_queue, untagging_queue):
+    """Merge the taggings queued during _interactive_duplicate_removal()
+    into a remaining member of each duplicate set, and untag the removed
+    files, committing all of it together, once.
+
+    Sets with no tagged member left on disk, and taggings whose tag or value
+    has since been deleted, are reported and skipped.
+    """
+    with batch(cursor):
+        for hash, toapply in tagging_queue.items():
+            # only files still on disk and known to TMSU can be tagged.
+            members = [f for f in dupes[hash]
+                       if fidmap.get(f) is not None and os.path.exists(f)]
+            if not members:
+                _msg('Skipping set {}: no tagged member remains'
+                     ' on disk'.format(hash))
+                continue
+            target = members[-1]
+            names = resolve_tag_values(cursor, toapply)
+            gone = [v for v in toapply if v not in names]
+            if gone:
+                _msg('Skipping deleted taggings {} for {}'.format(gone,
+                                                                  target))
+            toapply = [v for v in toapply if v in names]
+            if not toapply:
+                continue
+            tag_files(cursor, [fidmap[target]], toapply)
+            _msg('Tagged file {} ({}) : {}'.format(fidmap[target], target,
+                 " ".join(names[v] for v in toapply)))
+        for dead in untagging_queue:
+            deadid = fidmap.get(dead)
+            if deadid is None:
+                continue
+            _msg('Untagging file {}: {}'.format(deadid, dead))
+            delete_file_taggings(cursor, deadid)
+
+
 def _interactive_duplicate_removal(cursor, command, limit, minimum=2):
     from itertools import chain
 
@@ -356,66 +615,42 @@ def _interactive_duplicate_removal(cursor, command, limit, minimum=2):
         cmd()
         gone = removed(files)
         if gone:
-            for item in gone:
-                id = fidmap[item]
+            # taggings are only looked up for the files actually removed,
+            # rather than for every duplicate up front.
+            for item, tags in file_tags(cursor, gone).items():
                 q = tagging_queue.setdefault(hashmap[item], set())
-                q.update(taggings[id])
+                q.update(tags)
             untagging_queue.update(gone)
 
     def formatted_taggings(taggings):
-        return " ".join(resolve_tag_value(cursor, *v) for v in taggings)
-
-    def apply_queued_taggings():
-        for hash, toapply in tagging_queue:
-            members = [f for f in dupes[hash] if os.path.exists(pathmap[f])]
-            if not members:
-                raise ValueError('set reduced to 0 members(?)')
-            target = members[-1]
-            tag_files(cursor, [target], toapply)
-            _msg('Tagged file {} () : {}'.format(target,
-                 pathmap[target], formatted_taggings(toapply)))
-        for deadid in untagging_queue:
-            _msg('Untagging file {}: {}'.format(deadid, pathmap[deadid]))
-            delete_file_taggings(cursor, deadid)
-
+        return _formatted_taggings(cursor, taggings)
 
     untagging_queue = set()
     tagging_queue = {}
     _msg('getting dupes')
-    dupes = {k: v for k,v in duplicated_paths(cursor).items()
-             if sum(1 for v2 in v if os.path.exists(v2)) >= minimum}
+    dupes = duplicated_paths(cursor)
+    existing = _existing_paths(set(chain(*dupes.values())))
+    # number of -actual- dupes in each set, not counting items that don't
+    # exist on-disk.
+    setsizes = {k: sum(1 for v2 in v if v2 in existing)
+                for k, v in dupes.items()}
+    dupes = {k: v for k,v in dupes.items() if setsizes[k] >= minimum}
     _msg('ranking')
     dupes = rank_duplicates(dupes)
-    # ranking is by number of -actual- dupes, not counting items that don't
-    # exist on-disk.
     dupes_by_setsize = sorted(dupes.items(),
-                              key=lambda v:
-                                  sum(1 for v2 in v[1] if os.path.exists(v2)),
+                              key=lambda v: setsizes[v[0]],
                               reverse=True)
-    hashmap = {}
-
     _msg('making hashmap')
-    for hash, members in dupes.items():
-        for m in members:
-            hashmap[m] = hash
-
-    alldupes = set(chain(*dupes.values()))
+    hashmap = {m: hash for hash, members in dupes.items() for m in members}
+    # hashmap's keys are already each duplicated path, once.
+    alldupes = list(hashmap)
     _msg('getting fids')
     fidmap = file_ids(cursor, alldupes)
-    pathmap = {v:k for k,v in fidmap.items()}
     _msg('ndupes {}; nsets {}'.format(len(alldupes), len(dupes)))
     _msg('nfidmap {}'.format(len(fidmap)))
     _msg('nfidmap-null {}'.format(sum(1 for k,v in fidmap.items() if v is None)))
     #_msg(list(fidmap.items())[:2])
 
-    _msg('getting current taggings')
-    _msg('fidmap keys sample: {}'.format(list(fidmap.keys())[:8]))
-    taggings = {fidmap[k]: v
-                for k,v in file_tags(cursor, fidmap.keys()).items()}
-    _msg('Average {} taggings'.format(
-        sum(len(v) for v in taggings.values()) / len(taggings)))
-    _msg('taggings sample {}'.format(
-        list(taggings.items())[:10]))
     it = iter(dupes_by_setsize)
     buffer = [next(it)]
     total = sum(len(v[1]) for v in buffer)
@@ -438,8 +673,8 @@ def _interactive_duplicate_removal(cursor, command, limit, minimum=2):
                                     tagging_queue.items())[:10]]))
     _msg('untagging queue has {} items'.format(len(untagging_queue)))
     _msg('first 10 are: {}'.format(" ".join(k for k in list(untagging_queue)[:10])))
-    sys.exit(0)
-    apply_queued_taggings()
+    _apply_queued_taggings(cursor, dupes, fidmap,
+                           tagging_queue, untagging_queue)
 
 def parse_args(args):
     from tmsoup.core import _add_database_option, get_db_path
@@ -484,6 +719,7 @@ def parse_args(args):
                          ' to delete files from disk.',
                          default=None)
     group.add_argument('-s', '--stats',
+                         default=False, action='store_true',
                          help='Show stats about duplicates')
 
     resolve.add_argument('-1', '--single',
@@ -509,7 +745,6 @@ def parse_args(args):
     if args.cmd == 'dupes':
         if not args.command and (args.single or args.stdin):
             print ('--single and --stdin require --command')
-            import sys
             sys.exit(1)
         if args.stdin:
             args.limit = 0xffff
@@ -526,6 +761,7 @@ def parse_args(args):
 def main(argv, cursor=None):
     from plumbum.cmd import which
     import sqlite3
+    from operator import itemgetter
 
     def explode(*args,**kwargs):
         _msg(*args, **kwargs)
@@ -533,11 +769,14 @@ def main(argv, cursor=None):
 
     args = parse_args(argv)
     if not cursor:
-        cursor = sqlite3.connect(args.database).cursor()
+        cursor = set_bulk_pragmas(sqlite3.connect(args.database)).cursor()
 
     if args.cmd == 'dupes':
 
-        if args.command:
+        if args.stats:
+            for k, v in sorted(duplicate_stats(cursor).items()):
+                print('%-10s : %6d' % (k.title(), v))
+        elif args.command:
             args.command = args.command.split(" ")
             executable = which[args.command]().rstrip()
             print ('trying dupes')
@@ -558,12 +797,11 @@ def main(argv, cursor=None):
             import json
             json.dump(data, sys.stdout)
             summarystream = sys.stderr
-        for k, v in sorted(data.items(), key=lambda i:i[0]):
+        for k, v in sorted(data.items(), key=itemgetter(0)):
             print('%-10s : %6d' % (k.title(),len(v)), file=summarystream)
 
 
 if __name__ == '__main__':
-    import sys
     main(sys.argv[1:])
 
-__all__ = ('update_file_metadata',)
+__all__ = ('update_file_metadata', 'duplicate_stats', 'repair_paths')
@@ -29,33 +29,36 @@ def count_directory_tags(cursor, directory, limit=None, names=False, recursive=F
 
     """
     limit = limit or 0xffffff
-    while directory[-1] == os.path.sep:
-        directory = directory[:-1]
-    print ('relativization test:')
-    normed = cursor.connection.normalize_path(directory)
-    print (directory, cursor.connection.normalize_path(directory))
-    directory = normed
-    if recursive:
-        total = cursor.execute('select count(*) from file'
-                               ' where directory = ? or directory like ?',
-                               (directory, directory + os.path.sep + '%')).fetchone()[0]
-    else:
-        total = cursor.execute('select count(*) from file where directory = ?', (directory,)).fetchone()[0]
-
+    directory = directory.rstrip(os.path.sep) or os.path.sep
+    directory = cursor.connection.normalize_path(directory)
+    # subdirectories are matched as a range of the (directory, name) index,
+    # which LIKE can't use (and LIKE would treat _ and % in names as wildcards).
+    prefix = directory.rstrip(os.path.sep) + os.path.sep
+    subdirs = (prefix, prefix[:-1] + chr(ord(os.path.sep) + 1))
     idfield = 'T.id' if not names else 'T.name'
     direxpr = 'directory = ?'
     params = (directory, limit)
     if recursive:
-        direxpr = 'directory = ? or directory like ?'
-        params = (directory, directory + os.path.sep + '%', limit)
+        direxpr = 'directory = ? or (directory >= ? and directory < ?)'
+        params = (directory,) + subdirs + (limit,)
 
-    return total, sorted(cursor.execute('select ' + idfield + ', count(*)'
+    # the file total rides along with each row, saving a separate query
+    # unless no file there is tagged at all.
+    rows = cursor.execute('with F as (select id from file where ' + direxpr + ')'
+        ' select ' + idfield + ', count(*), (select count(*) from F)'
         ' from file_tag'
         ' join tag as T on tag_id=T.id'
-        ' join (select id from file where ' + direxpr + ') as F on file_id=F.id'
+        ' where file_id in (select id from F)'
         ' group by tag_id'
         ' order by count(*)'
-        ' desc limit ?', params).fetchall(), key=lambda v:(v[1], v[0]))
+        ' desc limit ?', params).fetchall()
+    if rows:
+        total = rows[0][2]
+    else:
+        total = cursor.execute('select count(*) from file where ' + direxpr,
+                               params[:-1]).fetchone()[0]
+    return total, sorted(((id, count) for id, count, _ in rows),
+                         key=lambda v:(v[1], v[0]))
 
 
 if __name__ == '__main__':
@@ -1,20 +1,27 @@
-from .util import delete, rename, do_commit
+from .util import delete, rename, do_commit, connection_cached
 
 def tag_names(cursor):
     """Return a list of all tag names defined in this database"""
-    return list(v[0] for v in cursor.execute('SELECT name FROM tag'
-                                             ' ORDER BY name').fetchall())
+    return [name for (name,) in cursor.execute('SELECT name FROM tag'
+                                               ' ORDER BY name')]
 
 def tag_id_map(cursor):
     "Return a dictionary mapping tag name to id,"
-    " for all tag names defined by this database"
-    return dict(cursor.execute('SELECT name, id FROM tag'))
+    " for all tag names defined by this database."
+    " The result is cached per connection (see util.connection_cached),"
+    " and must not be modified."
+    return connection_cached(cursor, 'tag_id_map',
+                             lambda c: dict(c.execute('SELECT name, id'
+                                                      ' FROM tag')))
 
 
 def id_tag_map(cursor):
     "Return a dictionary mapping tag id to name,"
-    " for all tag ids defined by this database"
-    return {v: k for k, v in tag_id_map(cursor).items()}
+    " for all tag ids defined by this database."
+    " The result is cached per connection, and must not be modified."
+    return connection_cached(cursor, 'id_tag_map',
+                             lambda c: dict(c.execute('SELECT id, name'
+                                                      ' FROM tag')))
 
 
 def tag_name(cursor, id):
@@ -41,23 +48,34 @@ def tag_exists(cursor, name=None, id=None):
         raise ValueError('One of (name, id) must be specified')
 
     if name:
-        querypart = 'name = ?'
+        sql = 'SELECT id FROM tag WHERE name = ?'
         variable = name
     else:
-        querypart = 'id = ?'
+        sql = 'SELECT id FROM tag WHERE id = ?'
         variable = id
 
-    return cursor.execute('SELECT id FROM tag WHERE %s' % querypart,
-                          (variable,)).fetchone() is not None
+    return cursor.execute(sql, (variable,)).fetchone() is not None
 
 
 def discontiguous_tag_ids(cursor):
     "Return the set of all unused tag ids < the current max tag id value"
-    used = set(v[0] for v in cursor.execute('select id from tag'))
-    maxv = max(used)
-    possible = set(range(1, maxv+2))
-    available = possible.difference(used)
-    return available
+    # the gaps are found by SQLite; only they are brought into Python.
+    return {id for (id,) in cursor.execute('WITH RECURSIVE seq(id) AS'
+                                           ' (SELECT 1 UNION ALL'
+                                           ' SELECT id + 1 FROM seq WHERE'
+                                           ' id <= (SELECT MAX(id) FROM tag))'
+                                           ' SELECT id FROM seq'
+                                           ' EXCEPT SELECT id FROM tag')}
+
+
+# 1 if unused, otherwise the lowest id whose successor is unused
+_SQL_LOWEST_UNUSED_TAG_ID = ('SELECT CASE'
+                             ' WHEN NOT EXISTS (SELECT 1 FROM tag WHERE id = 1)'
+                             ' THEN 1'
+                             ' ELSE (SELECT MIN(T1.id) + 1 FROM tag AS T1'
+                             ' LEFT JOIN tag AS T2 ON T2.id = T1.id + 1'
+                             ' WHERE T2.id IS NULL)'
+                             ' END')
 
 
 def create_tag(cursor, name, reuse_old=False):
@@ -80,28 +98,17 @@ def create_tag(cursor, name, reuse_old=False):
     """
     if not name:
         raise ValueError('Tag name cannot be empty.')
-    if len(list(
-        cursor.execute('select id from tag where name = ?', (name,)))):
+    if cursor.execute('select id from tag where name = ?',
+                      (name,)).fetchone():
         raise ValueError('Tag name %r is already in use' % name)
 
     if reuse_old:
-        available = discontiguous_tag_ids(cursor)
-        if not available:
-            # This should never happen,
-            # unless the TMSU db exceeds ((2**64)-1) unique tags.
-            raise ValueError('Everyone out of the universe!')
-        id = min(available)
+        id = cursor.execute(_SQL_LOWEST_UNUSED_TAG_ID).fetchone()[0]
         cursor.execute('insert into tag(id, name) values (?,?)', (id, name))
-        do_commit(cursor)
-        actualid = cursor.execute('select id from tag where name = ?',
-                       (name,)).fetchone()[0][0]
-        if actualid != id:
-            raise ValueError('Asked for unused id %r, but got %r' % (id, actualid))
     else:
         cursor.execute('insert into tag(name) values (?)', (name,))
-        do_commit(cursor)
-        id = cursor.execute('select id from tag where name = ?',
-                 (name,)).fetchone()[0][0]
+        id = cursor.lastrowid
+    do_commit(cursor)
     return id
 
 
@@ -114,8 +121,10 @@ def rename_tag(cursor, oldname, newname):
 def delete_tag(cursor, name):
     raise NotImplementedError('tag deletion')
     # XXX we also need to 'delete from file_tag where tag_id = ?'
+    from .core import dispatch_hook
+    id = tag_id(cursor, name)
     delete(cursor, 'tag', name)
-    dispatch_hook('after-tag-delete')
+    dispatch_hook('after-tag-delete', cursor, id, name)
 
 
 def parse_args(args):
@@ -135,10 +144,10 @@ def parse_args(args):
 if __name__ == "__main__":
     import sys
     import sqlite3
-    from tmsoup.core import KeyExists, get_db_path
+    from tmsoup.core import KeyExists, get_db_path, set_bulk_pragmas
     from tmsoup.util import validate_name
     args = parse_args(sys.argv[1:])
-    conn = sqlite3.connect(get_db_path())
+    conn = set_bulk_pragmas(sqlite3.connect(get_db_path()))
     cursor = conn.cursor()
 
     if args.cmd == 'rename':
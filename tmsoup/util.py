@@ -1,7 +1,22 @@
-_RESERVEDNAMES = set('. .. and or not eq ne lt gt le ge'.split(' '))
-_RESERVEDNAMES.update({v.upper() for v in _RESERVEDNAMES})
+import re
+import string
+import weakref
+from contextlib import contextmanager
+
+_RESERVEDNAMES = frozenset(v for name in
+                           '. .. and or not eq ne lt gt le ge'.split(' ')
+                           for v in (name, name.upper()))
+
+# Fast path for validate_name(): word characters (Unicode L*, N* and '_')
+# plus ASCII punctuation/symbols other than ,/=()<> are always valid.
+# Names using any other characters are checked by Unicode category.
+_VALID_NAME_RE = re.compile('[\\w%s]+' % re.escape(
+    "".join(c for c in string.punctuation if c not in ',/=()<>')))
+_FORBIDDEN_CHARS = frozenset(' \t,/=()<>')
 
 defer_commit = False
+# Connections with an active batch() block.
+_batched = set()
 
 def validate_name(name):
     """Return if a name is valid per TMSU rules.
@@ -26,14 +41,18 @@ def validate_name(name):
     =======
     ValueError       when the name is not valid
     """
-    import unicodedata
-
     if name in _RESERVEDNAMES:
         raise ValueError('%r conflicts with reserved symbol name' % name)
 
-    invalid = {c for c in ' \t,/=()<>/' if c in name}
-    invalid.update(c for c in name
-                   if unicodedata.category(c)[0] not in 'LNPS')
+    if _VALID_NAME_RE.fullmatch(name):
+        return
+
+    import unicodedata
+
+    # each distinct character is only examined once.
+    invalid = {c for c in set(name)
+               if c in _FORBIDDEN_CHARS
+               or unicodedata.category(c)[0] not in 'LNPS'}
 
     if invalid:
         invalid = "".join(sorted(invalid))
@@ -43,6 +62,24 @@ def validate_name(name):
     return
     
 
+# Tables with a unique 'name' column that rename()/delete() may operate on.
+# Each maps to its prebuilt statements, so table names are never taken
+# from the caller verbatim (and each statement text stays constant).
+_NAME_TABLE_SQL = {
+    t: {'exists': 'SELECT 1 FROM %s WHERE name = ?' % t,
+        'existing': 'SELECT name FROM %s WHERE name IN (?, ?)' % t,
+        'rename': 'UPDATE %s SET name = ? WHERE name = ?' % t,
+        'delete': 'DELETE FROM %s WHERE name = ?' % t}
+    for t in ('tag', 'value', 'alias')}
+
+
+def _name_table_sql(tablename):
+    try:
+        return _NAME_TABLE_SQL[tablename]
+    except KeyError:
+        raise ValueError('%r is not a named table' % (tablename,)) from None
+
+
 def rename(cursor, tablename, oldname, newname):
     """Generic renaming for tables with a 'name' field and no name duplication.
 
@@ -51,28 +88,26 @@ def rename(cursor, tablename, oldname, newname):
 
     True if the rename succeeded.
     """
+    sql = _name_table_sql(tablename)
     if newname == '':
         raise ValueError('New name cannot be empty')
-    if not any(cursor.execute('select name from ' +
-                              tablename + ' where name = ?',
-                              (oldname,))):
+    # both names are checked with a single query.
+    existing = {name for (name,) in cursor.execute(sql['existing'],
+                                                   (oldname, newname))}
+    if oldname not in existing:
         raise KeyError('Attempt to rename nonexistent %s %r' %
                        (tablename, oldname))
 
-    if any(cursor.execute('select name from ' +
-                          tablename + ' where name = ?',
-                          (newname,))):
+    if newname in existing:
+        from .core import KeyExists
         raise KeyExists(tablename, newname)
 
-    conn = cursor.connection
-    oldchanges = conn.total_changes
-    do_commit(cursor)
-    cursor.execute('UPDATE ' + tablename +
-                   'SET name = ? where name = ?',
-                   (newname, oldname))
+    # the UPDATE and its verification share one transaction,
+    # committed (or rolled back) once.
+    cursor.execute(sql['rename'], (newname, oldname))
 
-    if (conn.changes - oldchanges) != 1:
-        conn.rollback()
+    if cursor.rowcount != 1:
+        do_rollback(cursor)
         return False
 
     do_commit(cursor)
@@ -87,29 +122,65 @@ def delete(cursor, tablename, name):
     True if the removal succeeded (ie. exactly one row was removed.)
 
     """
-    if not any(cursor.execute('select name from ' + tablename +
-                              ' where name = ?',
-                              (oldname,))):
+    sql = _name_table_sql(tablename)
+    if cursor.execute(sql['exists'], (name,)).fetchone() is None:
         raise KeyError('Attempt to delete nonexistent %s %r' %
-                       (tablename, oldname))
+                       (tablename, name))
 
-    conn = cursor.connection
-    oldchanges = conn.total_changes
-    do_commit(cursor)
-    cursor.execute('DELETE FROM ' + tablename +
-                   ' where name = ?',
-                   (newname, oldname))
+    cursor.execute(sql['delete'], (name,))
 
     # XXX rollback vs commit asymmetry..
-    if conn.changes - oldchanges != 1:
-        conn.rollback()
+    if cursor.rowcount != 1:
+        do_rollback(cursor)
         return False
 
     do_commit(cursor)
     return True
 
 
+# connection: {key: (stamp, value)}; connections are held weakly.
+_connection_cache = weakref.WeakKeyDictionary()
+
+
+def connection_cached(cursor, key, compute):
+    """Return compute(cursor), memoized for the cursor's connection.
+
+    The cached value is reused until that connection next modifies the
+    database (as measured by Connection.total_changes), or rolls back via
+    do_rollback() or batch(). Changes made by other connections or
+    processes, and rollbacks made directly on the connection, are not
+    detected. Connections that can't be weakly referenced (plain
+    sqlite3.Connection, rather than tmsoup.core.connect()'s) aren't cached.
+
+    The cached value is shared between callers, and must not be mutated.
+    """
+    conn = cursor.connection
+    stamp = conn.total_changes
+    try:
+        cache = _connection_cache.setdefault(conn, {})
+    except TypeError:
+        return compute(cursor)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    value = compute(cursor)
+    cache[key] = (stamp, value)
+    return value
+
+
+def _rollback(conn):
+    """Roll back conn, discarding values cached from the rolled back state."""
+    conn.rollback()
+    try:
+        _connection_cache.pop(conn, None)
+    except TypeError:
+        pass
+
+
 def do_commit(cursor):
+    if cursor.connection in _batched:
+        # batch() commits once, on exit.
+        return
     if defer_commit:
         # don't commit yet, we are running in CLI automation mode
         import sys
@@ -118,3 +189,52 @@ def do_commit(cursor):
     else:
         conn = cursor.connection
         conn.commit()
+
+
+class BatchRollback(Exception):
+    """Raised by do_rollback() inside a batch() block."""
+
+
+def do_rollback(cursor, error=None):
+    """Roll back the current transaction, then raise `error` if given.
+
+    Inside a batch() block, the work of the rest of the batch must not be
+    silently discarded, so instead `error` (or BatchRollback) is raised,
+    and batch() rolls back the whole batch as it propagates.
+    """
+    if cursor.connection in _batched:
+        raise error or BatchRollback('rollback requested inside batch()')
+    _rollback(cursor.connection)
+    if error is not None:
+        raise error
+
+
+@contextmanager
+def batch(cursor):
+    """Run the enclosed operations in a single transaction on cursor's
+    connection, committed once on exit (or rolled back on an exception).
+
+    While active, do_commit() on that connection does nothing, so bulk operations (tag_files(),
+    untag_files(), ...) don't each commit and sync the journal,
+    and do_rollback() raises rather than rolling back part of the batch.
+    The write lock is taken up front (BEGIN IMMEDIATE).
+
+    Only cursor's connection is affected; nested batch() blocks on the
+    same connection join the outermost one.
+    """
+    conn = cursor.connection
+    if conn in _batched:
+        yield cursor
+        return
+    _batched.add(conn)
+    try:
+        if not conn.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+        yield cursor
+    except BaseException:
+        _rollback(conn)
+        raise
+    else:
+        conn.commit()
+    finally:
+        _batched.discard(conn)